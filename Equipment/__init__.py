@@ -2,6 +2,27 @@
 import os
 os.environ["PYVISA_LIBRARY"] = "@py"
 
-# from .sdg6022x import SDG6022X
-from .agilent33600A import Agilent33600A
+import importlib
 
+# Driver classes and their modules. A driver module (and pylablib, pydantic,
+# pyvisa behind it) is only imported on first use of its class, so the
+# server can start answering before any of them has loaded.
+_drivers = {
+    'Agilent33600A': '.agilent33600A',
+    'SDG6022X': '.sdg6022x',
+}
+
+__all__ = list(_drivers)
+
+
+def __getattr__(name):
+    module = _drivers.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_drivers))
@@ -1,31 +1,171 @@
 from pylablib.devices import AWG
 import numpy as np
-import time
-from typing import Literal, Annotated, Union, TextIO, BinaryIO
+import json
+import contextlib
+from typing import Literal, Annotated, Optional, Union, TextIO, BinaryIO
 
 from pydantic import validate_call, Field
 import os
-import streamlit as st
-from core import get_public_commands
+from core import get_public_commands, long_running, runs_live, Metrics
+from .waveform_io import iter_dac_chunks, prefetch, read_waveform, numbered_file, load_column, column_table
+from .visa_utils import write_binary_block, terminate_socket_writes, root_scpi_message, wait_complete, ESR_ERRORS
+from .transport import select_address, transport_of
+from .waveform_synth import SharedWaveform, use_pool
+from .waveform_cache import WaveformCache
+from .shadow_state import ShadowState
 
 os.environ["PYVISA_LIBRARY"] = "@py"
 
 ChannelType = Literal[1, 2]
 
+# Full scale of DATA:ARB:DAC samples
+DAC_MAX = 32767
+
+# Longest waveform loaded into one ARB slot by A33LoadArbitraryVolat
+ARB_MAX_POINTS = 4_000_000
+
+# DATA:SEQ step play controls and marker modes, and the sequence limits
+SEQUENCE_PLAY = ('once', 'onceWaitTrig', 'repeat', 'repeatInf', 'repeatTilTrig')
+SEQUENCE_MARKERS = ('maintain', 'lowAtStart', 'highAtStart', 'highStartGoLow')
+SEQUENCE_MAX_STEPS = 512
+SEQUENCE_MAX_REPEAT = 1_000_000
+
 class Agilent33600A(AWG.GenericAWG):
     """
     Driver for Keysight/Agilent 33600A series AWGs with Pydantic validation
     and integrated command registry.
     """
-
-    def __init__(self, addr, channels_number=2):
+    # Writes inside batch()/using_write_buffer() are sent as ';'-joined messages
+    _allow_concatenate_write = True
+    _concatenate_write_separator = ";"
+    # Longest coalesced message sent in one go (kept well inside the input buffer)
+    _max_write_length = 8192
+    # No 10 ms pause after every write (GenericAWG's default): the
+    # instrument queues commands, and the operations that take time are
+    # waited for explicitly (see visa_utils.wait_complete)
+    _default_operation_cooldown = {"write": 0}
+    # Queries timed to pick the transport (see Equipment.transport): a short
+    # round trip, and the screen image, which comes back as a binary block
+    _transport_probe = ('*IDN?', 'HCOP:SDUM:DATA?')
+
+    def __init__(self, addr, channels_number=2, transport=None):
+        """
+        transport : None, 'auto', 'inst', 'hislip' or 'socket'
+            None opens addr as it is; 'auto' probes VXI-11, HiSLIP and the
+            raw socket on addr's host and keeps the fastest.
+        """
         self._channels_number = channels_number
+        addr, self._transport_results = select_address(addr, transport, *self._transport_probe)
+        # Content hashes of the waveforms resident in each channel's ARBn slots
+        self._wfm_cache = WaveformCache()
+        # Last value sent for each setting, so unchanged ones aren't re-sent.
+        # Changing the function or the load re-derives the channel's other
+        # settings on the instrument, so those clear its shadow.
+        self._shadow = ShadowState(
+            actions=[r'MMEM', r'(SOUR\d:)?DATA'],
+            resync_on=[r'SOUR\d:FUNC$', r'OUTP\d:LOAD$'],
+        )
         super().__init__(addr)
+        terminate_socket_writes(self.instr)
         visa_instr = self.instr.instr
         visa_instr.timeout = 10_000
         visa_instr.chunk_size = 4 * 1024 * 1024
 
         self.commands = get_public_commands(self)
+
+    def transport_info(self):
+        """The VISA resource in use, its transport and the results of the 'auto' probe."""
+        resource = self.instr.instr.resource_name
+        return {"resource": resource, "transport": transport_of(resource), "probe": self._transport_results}
+
+    def open(self):
+        # Volatile memory may have changed while we were disconnected
+        self._wfm_cache.invalidate()
+        self._shadow.invalidate()
+        super().open()
+        terminate_socket_writes(self.instr)
+
+    def reconnect(self, *args, **kwargs):
+        self._wfm_cache.invalidate()
+        self._shadow.invalidate()
+        super().reconnect(*args, **kwargs)
+        terminate_socket_writes(self.instr)
+
+    def _instr_write(self, msg):
+        with Metrics.phase('io', 'VISA write', msg):
+            Metrics.count('visa_bytes_written', len(msg))
+            try:
+                return super()._instr_write(msg)
+            except BaseException:
+                # The shadow already has msg's settings, which may not have
+                # got there: resend everything next time
+                self._shadow.invalidate()
+                raise
+
+    def _instr_read(self, raw=False, size=None):
+        with Metrics.phase('io', 'VISA read'):
+            data = super()._instr_read(raw, size)
+        Metrics.count('visa_bytes_read', len(data))
+        return data
+
+    def write(self, msg, arg=None, *args, **kwargs):
+        if arg is None and not args and not kwargs:
+            # Drop the settings the instrument already has
+            msg = self._shadow.filter(msg)
+            if not msg:
+                return
+        else:
+            # pylablib-style setter: header spelling unknown, start over
+            self._shadow.invalidate()
+        return super().write(msg, arg, *args, **kwargs)
+
+    def _write_retry(self, msg="", flush=False):
+        if self._concatenate_write and msg:
+            msg = root_scpi_message(msg)
+            # Send what is buffered first if msg would push it over the limit
+            if self._write_buffer and len(self._write_buffer) + len(msg) + 1 > self._max_write_length:
+                super()._write_retry(flush=True)
+        return super()._write_retry(msg, flush)
+
+    @contextlib.contextmanager
+    def batch(self, wait: bool = True):
+        """
+        Buffer every write made inside the block and send them as few
+        ';:'-joined SCPI messages as _max_write_length allows.
+
+        On leaving the outermost batch the remaining writes go out together
+        with *OPC? (if wait=True), so the whole block costs one round trip and
+        returns once the instrument has applied it. Queries and raw transfers
+        inside the block flush the buffer first, so ordering is kept. If the
+        block raises, what is still buffered is dropped and its error is the
+        one raised.
+
+            with awg.batch():
+                awg.A33ConfigureWFM(...)
+                awg.A33OutputOnOff(...)
+        """
+        outermost = not self._concatenate_write
+        self._concatenate_write += 1
+        try:
+            yield self
+        except BaseException:
+            if outermost:
+                # Never sent, so the shadow doesn't know what the instrument has
+                self._write_buffer = ""
+                self._shadow.invalidate()
+            raise
+        finally:
+            self._concatenate_write -= 1
+        if outermost:
+            pending, self._write_buffer = self._write_buffer, ""
+            if pending and wait:
+                self.ask(pending + ";*OPC?")
+            elif pending:
+                self._write_retry(pending)
+
+    def _flush_writes(self):
+        """Send any writes still held by using_write_buffer() before raw I/O."""
+        self._write_retry(flush=True)
         
 #Unused - delivers arb waveform as floats rather than ints which means it doens't
 # use the full range of the DAC
@@ -45,100 +185,156 @@ class Agilent33600A(AWG.GenericAWG):
     #     self.write("*WAI")
     #     self.write("DISP:TEXT ''")
 
-    def _upload_custom_waveform_dac_binary(
-        self,
-        waveform,
-        arb_index: int,
-        channel: int = 1,
-        max_attempts: int=10
-        ):
+    def _prepare_dac_block(self, waveform, arb_index: int, channel: int = 1):
         """
-        Upload arbitrary waveform using DATA:ARB:DAC (raw DAC codes).
-        waveform : array-like
-            Integer DAC samples (already scaled/clipped).
-        arb_index : int
-            ARB memory index (e.g. 1 -> ARB1).
-        channel : int
-            Output channel (1 or 2).
+        Build everything needed to send one DATA:ARB:DAC transfer.
+        The samples are clipped straight into a little-endian int16 buffer
+        (matching FORM:BORD SWAP), which is the only copy made of the data.
+        Contiguous little-endian int16 data already within +-DAC_MAX (memory-
+        mapped files, synthesized waveforms) is sent as it is, without a copy.
+
+        Returns (channel, arb_index, cmd, payload, digest).
         """
-        # Convert to signed 16-bit integers (33600A DAC mode expects integers)
-        waveform = np.asarray(waveform, dtype=np.int16)
-        payload = waveform.tobytes()
-        visa_instr = self.instr.instr
-        
-        old_timeout = visa_instr.timeout
-        visa_instr.timeout = 60_000
-        
-        byte_count = len(payload)
-        len_str = str(byte_count)
-        header = f"#{len(len_str)}{len_str}".encode("ascii")
+        waveform = np.asarray(waveform)
+        if (waveform.dtype == np.dtype('<i2') and waveform.flags.c_contiguous
+                and waveform.min(initial=0) >= -DAC_MAX):
+            payload = waveform
+        else:
+            payload = np.empty(waveform.shape, dtype='<i2')
+            np.clip(waveform, -DAC_MAX, DAC_MAX, out=payload, casting='unsafe')
 
         cmd = (
             f"FORM:BORD SWAP;:SOUR{channel}:DATA:ARB:DAC ARB{arb_index},"
             .encode("ascii")
         )
-        # Full message
-        message = cmd + header + payload# + b";\n"
+        return channel, arb_index, cmd, payload, WaveformCache.digest(payload)
+
+    def _iter_dac_blocks(self, chunks, arb_start_index: int, channel: int = 1):
+        for i, chunk in enumerate(chunks):
+            yield self._prepare_dac_block(chunk, arb_start_index + i, channel)
 
+    def _send_dac_block(self, block, max_attempts: int = 10):
+        """
+        Write a block from _prepare_dac_block, wait until the instrument
+        reports it processed (visa_utils.wait_complete) and check for errors,
+        retrying up to max_attempts times.
+
+        The upload is skipped if the waveform cache says identical data is
+        already resident in ARB{arb_index} of this channel.
+        """
+        channel, arb_index, cmd, payload, digest = block
+        if self._wfm_cache.lookup(channel, arb_index, digest):
+            print(f"Waveform ARB{arb_index} already resident on channel {channel}, upload skipped")
+            return
+
+        # Whatever was in the slot is gone once we start writing to it, and
+        # FUNC:ARB has to be sent again to pick up the new data
+        self._wfm_cache.invalidate(channel, arb_index)
+        self._shadow.invalidate(channel)
+        self._flush_writes()
+        visa_instr = self.instr.instr
 
         last_err = None
         for attempt in range(1, max_attempts + 1):
+            if attempt > 1:
+                Metrics.count('upload_retries')
             try:
-                # Write waveform
-                visa_instr.write_raw(message)
+                # Write waveform: command, block header and payload are sent
+                # without concatenating them into one copy
+                write_binary_block(visa_instr, cmd, payload)
 
-                # Short wait between attempts (like 100 ms)
-                time.sleep(0.1)
+                # Returns as soon as the instrument has processed the block
+                esr = wait_complete(self, label='*OPC (DATA:ARB:DAC)')
 
-                opc_reply = self.ask("*OPC?")
-     
-                if opc_reply != "1":
-                    # Optional: if not done, wait longer (LabVIEW style)
-                    time.sleep(20)  # 20 seconds, emulate LabVIEW long wait
-
-                # Check instrument error
-                err = self.ask("SYST:ERR?")
+                # Only ask for the error when the status says there is one
+                err = self.ask("SYST:ERR?") if esr & ESR_ERRORS else '+0,"No error"'
                 
                 if err==('+0,"No error"'):
                     # Success
                     print(f"Waveform ARB{arb_index} uploaded successfully on attempt {attempt}")
-                    visa_instr.timeout = old_timeout
+                    self._wfm_cache.store(channel, arb_index, digest)
                     return
                 else:
                     last_err = err
+                    self._shadow.invalidate()
                     print(f"Attempt {attempt}: Instrument busy/error -> {err}")
 
             except Exception as e:
                 last_err = str(e)
                 print(f"Attempt {attempt}: Exception -> {last_err}")
         
-        visa_instr.timeout = old_timeout
         # If we exit the loop without success
         raise RuntimeError(
             f"Failed to upload ARB waveform after {max_attempts} attempts. Last error: {last_err}"
         )
 
+    def _upload_custom_waveform_dac_binary(
+        self,
+        waveform,
+        arb_index: int,
+        channel: int = 1,
+        max_attempts: int=10
+        ):
+        """
+        Upload arbitrary waveform using DATA:ARB:DAC (raw DAC codes).
+        waveform : array-like
+            Integer DAC samples (already scaled/clipped).
+        arb_index : int
+            ARB memory index (e.g. 1 -> ARB1).
+        channel : int
+            Output channel (1 or 2).
+        """
+        visa_instr = self.instr.instr
+        
+        old_timeout = visa_instr.timeout
+        visa_instr.timeout = 60_000
+        try:
+            block = self._prepare_dac_block(waveform, arb_index, channel)
+            self._send_dac_block(block, max_attempts=max_attempts)
+        finally:
+            visa_instr.timeout = old_timeout
+
+    @long_running
     def load_split_and_upload_dac(
         self,
-        data: Union[str, np.ndarray, TextIO, BinaryIO],
+        data: Union[str, os.PathLike, np.ndarray, TextIO, BinaryIO, dict],
         arb_start_index: int,
         channel: int = 1,
         chunk_size: int = 4_000_000,
+        pipelined: bool = True,
     ):
         """
         Load waveform data, split into chunks, auto-increment names with _XX suffix,
         and upload each chunk using DATA:ARB:DAC.
 
+        Data is streamed: each chunk is uploaded as soon as it has been read,
+        while the next one is parsed in the background, so only about one
+        chunk is ever held in memory.
+
         Parameters
         ----------
-        data : str | Path | array-like
-            Path to file (loaded via np.load) or waveform array.
+        data : str | Path | file object | array-like | dict
+            Path to a .npy file (memory-mapped), a raw little-endian int16 file
+            (.bin/.raw/.i16/.dat, memory-mapped), an ASCII file with one integer
+            per line, an open ASCII file object, a waveform array, or a
+            waveform spec (tones, chirps, pulses... see
+            Equipment.waveform_synth) synthesized on the server chunk by chunk.
         arb_start_index : int
             Starting ARB memory index (ARBn).
         channel : int
             Output channel.
         chunk_size : int
             Number of points per chunk (default: 4M).
+        pipelined : bool
+            If True (default), a background thread reads and prepares chunk N+1
+            (clip, convert, header) while chunk N is on the wire, and each chunk
+            is sent as soon as the instrument reports the previous one done.
+            If False, each chunk is prepared only after the previous one is
+            confirmed.
+
+        Long specs are rendered by a pool of processes into shared memory
+        and the chunks are uploaded straight from there, the first one as
+        soon as its segments are done (see waveform_synth.SharedWaveform).
             
         #Works best if you first clear both channels.
         awg.A33ClearArbitrary(1)
@@ -146,43 +342,141 @@ class Agilent33600A(AWG.GenericAWG):
         awg.load_split_and_upload_dac(f,1)
             
         """
+        if isinstance(data, dict) and use_pool(data):
+            with SharedWaveform(data, chunk_size) as waveform:
+                return self.load_split_and_upload_dac(waveform, arb_start_index, channel, chunk_size, pipelined)
+
+        if not pipelined:
+            # closing(): a failed upload stops the reader and drops its chunk
+            with contextlib.closing(prefetch(iter_dac_chunks(data, chunk_size))) as chunks:
+
+                # ---- Upload each chunk as it becomes available -----------------
+                for i, chunk in enumerate(chunks):
+                    arb_index = arb_start_index + i
+
+                    self._upload_custom_waveform_dac_binary(
+                        waveform=chunk,
+                        arb_index=arb_index,
+                        channel=channel,
+                    )
+            return
+
+        # ---- Producer: load + prepare, consumer: send + confirm -------------------
+        blocks = prefetch(
+            self._iter_dac_blocks(iter_dac_chunks(data, chunk_size), arb_start_index, channel)
+        )
+        visa_instr = self.instr.instr
+        old_timeout = visa_instr.timeout
+        visa_instr.timeout = 60_000
+        try:
+            with contextlib.closing(blocks):
+                for block in blocks:
+                    self._send_dac_block(block)
+        finally:
+            visa_instr.timeout = old_timeout
+
+    @staticmethod
+    def _sequence_step(step):
+        """(repeat, play, marker, marker_point) of a load_sequence_dac step, checked."""
+        repeat = int(step.get('repeat', 1))
+        play = step.get('play', 'once' if repeat == 1 else 'repeat')
+        marker = step.get('marker', 'maintain')
+        marker_point = int(step.get('marker_point', 4))
+        if play not in SEQUENCE_PLAY:
+            raise ValueError(f"Sequence play control must be one of {SEQUENCE_PLAY}, got {play!r}")
+        if marker not in SEQUENCE_MARKERS:
+            raise ValueError(f"Sequence marker mode must be one of {SEQUENCE_MARKERS}, got {marker!r}")
+        if not 1 <= repeat <= SEQUENCE_MAX_REPEAT:
+            raise ValueError(f"Sequence repeat count must be 1..{SEQUENCE_MAX_REPEAT}, got {repeat}")
+        return repeat, play, marker, marker_point
+
+    @staticmethod
+    def _sequence_descriptor(name, steps):
+        """
+        The DATA:SEQ block: "name","ARBn",repeat,play,marker,point,...
+        steps : list of (arb_index, repeat, play, marker, marker_point)
+        """
+        fields = [f'"{name}"']
+        for arb_index, repeat, play, marker, marker_point in steps:
+            fields.append(f'"ARB{arb_index}",{repeat},{play},{marker},{marker_point}')
+        return ','.join(fields).encode('ascii')
+
+    @long_running
+    @runs_live
+    def load_sequence_dac(
+        self,
+        steps: list,
+        channel: int = 1,
+        name: str = 'SEQ1',
+        arb_start_index: int = 1,
+    ):
+        """
+        Upload the segments of a sequence and play them back to back from a
+        DATA:SEQ sequence descriptor (selected as the channel's arb).
+
+        steps : list of dict
+            data          the segment's DAC samples (path, array or waveform
+                          spec, like load_split_and_upload_dac), at most
+                          ARB_MAX_POINTS points
+            repeat        times the segment is played (default 1)
+            play          once, onceWaitTrig, repeat, repeatInf or
+                          repeatTilTrig (default: once, repeat if repeat > 1)
+            marker        maintain (default), lowAtStart, highAtStart or
+                          highStartGoLow
+            marker_point  sample where the marker changes (default 4)
+
+        Segments with identical samples are uploaded once, into
+        ARB{arb_start_index}, ARB{arb_start_index + 1}..., and referenced by
+        every step that plays them; consecutive steps repeating the same
+        segment with the same marker are merged into one step. A segment
+        already resident in its slot isn't sent again.
+
+        Returns the number of uploaded segments and of sequence steps as JSON.
+        """
+        if not steps:
+            raise ValueError('A sequence needs at least one step')
+        slots = {}          # { digest: arb index }
+        sequence = []       # [ [arb_index, repeat, play, marker, marker_point] ]
+        visa_instr = self.instr.instr
+        old_timeout = visa_instr.timeout
+        visa_instr.timeout = 60_000
+        try:
+            for i, step in enumerate(steps):
+                repeat, play, marker, marker_point = self._sequence_step(step)
+                waveform = read_waveform(step['data'], ARB_MAX_POINTS)
+                block = self._prepare_dac_block(waveform, arb_start_index + len(slots), channel)
+                digest = block[-1]
+                if digest not in slots:
+                    slots[digest] = block[1]
+                    self._send_dac_block(block)
+                del waveform, block
+                arb_index = slots[digest]
+
+                last = sequence[-1] if sequence else None
+                if (last is not None and last[0] == arb_index and last[2] in ('once', 'repeat')
+                        and play in ('once', 'repeat') and last[3:] == [marker, marker_point]
+                        and last[1] + repeat <= SEQUENCE_MAX_REPEAT):
+                    last[1] += repeat
+                    last[2] = 'repeat'
+                else:
+                    sequence.append([arb_index, repeat, play, marker, marker_point])
+        finally:
+            visa_instr.timeout = old_timeout
+        if len(sequence) > SEQUENCE_MAX_STEPS:
+            raise ValueError(f"The sequence has {len(sequence)} steps, the instrument takes {SEQUENCE_MAX_STEPS}")
+
+        self._shadow.invalidate(channel)
+        self._flush_writes()
+        write_binary_block(
+            visa_instr, f':SOUR{channel}:DATA:SEQ '.encode('ascii'), np.frombuffer(
+                self._sequence_descriptor(name, sequence), dtype=np.uint8)
+        )
+        self.write(f':SOUR{channel}:FUNC:ARB {name};:SOUR{channel}:FUNC ARB;')
+        err = self.ask('SYST:ERR?')
+        if err != '+0,"No error"':
+            raise RuntimeError(f"Sequence {name} was not accepted: {err}")
+        return json.dumps({"segments": len(slots), "steps": len(sequence)})
 
-        # ---- Load data ---------------------------------------------------------
-        if hasattr(data, "read"):
-            try:
-                waveform = np.loadtxt(data, dtype=np.int32)
-            except Exception as exc:
-                raise ValueError(
-                    f"Failed to load DAC waveform from '{data}'. "
-                    "File must contain 1D integer ASCII data "
-                    "(valid for DATA:ARB:DAC)."
-                ) from exc
-
-            if waveform.ndim != 1:
-                raise ValueError(
-                    f"Waveform data in '{data}' must be 1D, got shape {waveform.shape}."
-                )
-        else:
-            waveform = np.asarray(data)
-
-        total_points = waveform.shape[0]
-
-        counter = arb_start_index
-        # ---- Split and upload --------------------------------------------------
-        num_chunks = (total_points + chunk_size - 1) // chunk_size
-
-        for i in range(num_chunks):
-            chunk = waveform[i * chunk_size : (i + 1) * chunk_size]
-
-            name = f"{counter + i:01d}"
-            arb_index = arb_start_index + i
-
-            self._upload_custom_waveform_dac_binary(
-                waveform=chunk,
-                arb_index=arb_index,
-                channel=channel,
-            )
-            time.sleep(5)
     # -----------------------------------------------------------------------
     # Registered Commands
     # -----------------------------------------------------------------------
@@ -192,10 +486,13 @@ class Agilent33600A(AWG.GenericAWG):
         """Syncs Arb phase."""
         self.write(":FUNC:ARB:SYNC;")
 
+    @runs_live
     @validate_call
     def A33ClearArbitrary(self, channel: ChannelType):
         """Clears volatile memory for the specified channel."""
         self.write(f"SOUR{channel}:DATA:VOL:CLE;")
+        self._wfm_cache.invalidate(channel)
+        self._shadow.invalidate(channel)
         # self.ask("*OPC?")
 
     @validate_call
@@ -262,7 +559,7 @@ class Agilent33600A(AWG.GenericAWG):
         channel: ChannelType, 
         burst_mode: bool, # 0=Triggered, 1=Gated
         burst_phase: Annotated[float, Field(ge=-360, le=360)], 
-        burst_count: Annotated[int, Field(ge=1)], 
+        burst_count: Annotated[int, Field(ge=0)], # 0=infinite
         gate_polarity: bool, # 0=Norm, 1=Inv
         internal_period: Annotated[float, Field(gt=0)], 
         enable_burst: bool
@@ -275,7 +572,7 @@ class Agilent33600A(AWG.GenericAWG):
             else: # Triggered
                 cmd = f'SOUR{channel}:BURS:MODE TRIG;:'
                 cmd += f'SOUR{channel}:BURS:PHAS {burst_phase:#.16g};:'
-                cmd += f'SOUR{channel}:BURS:NCYC {burst_count:.0f};:'
+                cmd += f'SOUR{channel}:BURS:NCYC {burst_count if burst_count else "INF"};:'
             
             cmd += f'SOUR{channel}:BURS:STAT ON'
         else:
@@ -402,6 +699,7 @@ class Agilent33600A(AWG.GenericAWG):
         
         self.write(cmd)
 
+    @validate_call
     def A33ConfigureWFM(
         self, 
         channel: ChannelType, 
@@ -435,28 +733,84 @@ class Agilent33600A(AWG.GenericAWG):
         full_cmd = ':' + ';:'.join(cmds) + ';'
         self.write(full_cmd)
 
+    @runs_live
     @validate_call
     def A33Initialize(self, reset: bool): 
         if reset:
             self.write('*RST')
-            time.sleep(0.5)
+            self._wfm_cache.invalidate()
+            self._shadow.invalidate()
         self.write('*CLS;*ESE 1;*SRE 32;')
-        time.sleep(0.5)        
-        self.write('*WAI;')
-        time.sleep(0.5)
         self.write(':ROSCillator:SOURce:AUTO  ON;')
+        # Return once the reset and the settings above have taken effect
+        wait_complete(self, label='*OPC (initialize)')
 
 
-    @validate_call
+    @long_running
+    @validate_call(config=dict(arbitrary_types_allowed=True))
     def A33LoadArbitraryVolat(
         self, 
         channel: ChannelType, 
-        arb_number: Literal[1, 2, 3, 4],
-        wfm_column_number: str, 
-        wfm_source: bool, # 0=NORM, 1=INV
-        array_wfm: Annotated[float, Field(gt=0)], 
+        arb_number: Annotated[int, Field(ge=1)],
+        wfm_column_number: Annotated[int, Field(ge=0)] = 0,
+        wfm_length: Optional[Annotated[int, Field(ge=8, le=ARB_MAX_POINTS)]] = None,
+        wfm_source: Annotated[int, Field(ge=0, le=2)] = 2, # 0=columns of a file, 1=NAME_nn files, 2=array
+        array_wfm: Union[np.ndarray, list[float], None] = None,
+        wfm_file: Optional[str] = None,
     ):
-        None
+        """
+        Load a waveform into volatile memory as ARB{arb_number} (A33ARBVOL).
+
+        wfm_source selects where the samples (DAC codes, -32767..32767) come from:
+            0: column wfm_column_number (0 = first) of the multi-column file
+               wfm_file. Text files are indexed into a column sidecar the first
+               time (see A33IndexWaveformFile), then columns are memory-mapped.
+            1: the file wfm_file names with _nn appended, nn = wfm_column_number
+               (e.g. 'wfms/NAME.txt' -> 'wfms/NAME_07.txt').
+            2: array_wfm, normally sent as a binary ZMQ frame (see
+               core.Server.attach_arrays); float arrays are scaled from -1..+1.
+        Only the first wfm_length samples are loaded if it is given; the
+        waveform must have 8 to ARB_MAX_POINTS samples whatever its source.
+        """
+        if wfm_source == 2:
+            if array_wfm is None:
+                raise ValueError('wfm_source 2 needs array_wfm')
+            waveform = np.asarray(array_wfm)
+            if waveform.ndim != 1:
+                raise ValueError(f'array_wfm must be 1D, got shape {waveform.shape}')
+            if waveform.dtype.kind == 'f':
+                waveform = waveform * DAC_MAX
+        elif wfm_file is None:
+            raise ValueError(f'wfm_source {wfm_source} needs wfm_file')
+        elif wfm_source == 0:
+            waveform = load_column(wfm_file, wfm_column_number)
+        else:
+            waveform = read_waveform(
+                numbered_file(wfm_file, wfm_column_number),
+                wfm_length or ARB_MAX_POINTS,
+                truncate=wfm_length is not None,
+            )
+
+        if wfm_length is not None:
+            waveform = waveform[:wfm_length]
+        # Same limits as wfm_length, checked here for every source
+        if not 8 <= len(waveform) <= ARB_MAX_POINTS:
+            raise ValueError(
+                f'Waveform for ARB{arb_number} has {len(waveform)} points, '
+                f'the 33600A takes 8 to {ARB_MAX_POINTS}'
+            )
+        self._upload_custom_waveform_dac_binary(waveform, arb_number, channel)
+
+    @long_running
+    @validate_call
+    def A33IndexWaveformFile(self, wfm_file: str):
+        """
+        Build (or refresh) the column sidecar of a multi-column text waveform
+        file ahead of A33LoadArbitraryVolat with wfm_source=0.
+        Returns the number of samples and columns as JSON.
+        """
+        rows, columns = column_table(wfm_file).shape
+        return json.dumps({"samples": rows, "columns": columns})
 
 
     @validate_call
@@ -485,14 +839,34 @@ class Agilent33600A(AWG.GenericAWG):
     @validate_call
     def A33ReadError(self):  
         err = self.ask('SYST:ERR?')
+        if not err.startswith(('+0', '0')):
+            # Some write was rejected, so the shadow can't be trusted
+            self._shadow.invalidate()
         return err
 
     @validate_call
     def A33Trg(self):  
         self.write('*TRG;')
 
+    @validate_call
+    def A33WaveformCacheStats(self):
+        """Waveform cache hit/miss counters and resident ARB slots, as JSON."""
+        return json.dumps(self._wfm_cache.stats())
+
+    @runs_live
+    @validate_call
+    def A33ResyncState(self):
+        """Forget the shadowed settings so the next writes are all sent."""
+        self._shadow.invalidate()
+
+    @validate_call
+    def A33ShadowStats(self):
+        """Number of suppressed writes and of shadowed settings, as JSON."""
+        return json.dumps(self._shadow.stats())
+
 
         
+    @long_running
     @validate_call
     def A33LoadARB(self, channel: ChannelType, arb_number: int):
         visa = self.instr.instr
@@ -501,11 +875,14 @@ class Agilent33600A(AWG.GenericAWG):
         # Build command with *OPC? for synchronization
         cmd = f':MMEM:LOAD:DATA{channel} "INT:\\332XX_ARBS\\ARBF{arb_number}.ARB";*OPC?'
         
+        self._shadow.invalidate(channel)
         self.write(cmd)
+        self._flush_writes()
         visa.timeout = 60_000 # 60s timeout for large file transfer
         
         # Read blocks until *OPC? returns '1'
-        response = visa.read()
+        with Metrics.phase('wait', '*OPC? (MMEM:LOAD)'):
+            response = visa.read()
         visa.timeout = old_timeout
         return response
     
@@ -530,6 +907,7 @@ class Agilent33600A(AWG.GenericAWG):
     #         awg.load_split_and_upload_dac(f,1)
             
 
+#     import streamlit as st   # only for this UI, not at module load
 #     st.set_page_config(page_title="Agilent 33600A Controller", layout="wide")
 #     st.title("Agilent 33600A Series Controller")
 # # "TCPIP::127.0.0.1::5025::SOCKET"
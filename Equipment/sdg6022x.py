@@ -1,16 +1,87 @@
 from pylablib.core.devio import SCPI
 import numpy as np
-from core.Registry import register_command
+import json
+from core import get_public_commands, runs_live, Metrics
+from .visa_utils import write_binary_block, terminate_socket_writes
+from .transport import select_address, transport_of
+from .waveform_cache import WaveformCache
+from .shadow_state import ShadowState
 
 
 class SDG6022X(SCPI.SCPIDevice):
-    def __init__(self, addr):
+    # Query timed to pick the transport (see Equipment.transport); the screen
+    # dump (SCDP) isn't an IEEE block, so there is no bulk probe
+    _transport_probe = ('*IDN?', None)
+
+    def __init__(self, addr, transport=None):
+        """
+        transport : None, 'auto', 'inst', 'hislip' or 'socket'
+            None opens addr as it is; 'auto' probes the transports on addr's
+            host and keeps the fastest.
+        """
+        addr, self._transport_results = select_address(addr, transport, *self._transport_probe)
+        # Content hashes of the named waveforms uploaded to each channel
+        self._wfm_cache = WaveformCache()
+        # Last value sent for each 'Cn:BSWV NAME' style setting; a new wave
+        # type or load re-derives the channel's other parameters
+        self._shadow = ShadowState(
+            param_pairs=True,
+            resync_on=[r'C\d:BSWV WVTP$', r'C\d:OUTP LOAD$'],
+        )
         super().__init__(addr, term_write="\n", term_read="\n")
+        terminate_socket_writes(self.instr)
 
         # Access the raw PyVISA resource to adjust timeouts
         raw_dev = self.instr.instr
         raw_dev.timeout = 20_000          # 20s timeout (uploading large ARBs takes time)
         raw_dev.chunk_size = 4 * 1024 * 1024  # 4MB chunk size
+
+        self.commands = get_public_commands(self)
+
+    def transport_info(self):
+        """The VISA resource in use, its transport and the results of the 'auto' probe."""
+        resource = self.instr.instr.resource_name
+        return {"resource": resource, "transport": transport_of(resource), "probe": self._transport_results}
+
+    def open(self):
+        # Wave memory may have changed while we were disconnected
+        self._wfm_cache.invalidate()
+        self._shadow.invalidate()
+        super().open()
+        terminate_socket_writes(self.instr)
+
+    def reconnect(self, *args, **kwargs):
+        self._wfm_cache.invalidate()
+        self._shadow.invalidate()
+        super().reconnect(*args, **kwargs)
+        terminate_socket_writes(self.instr)
+
+    def _instr_write(self, msg):
+        with Metrics.phase('io', 'VISA write', msg):
+            Metrics.count('visa_bytes_written', len(msg))
+            try:
+                return super()._instr_write(msg)
+            except BaseException:
+                # The shadow already has msg's settings, which may not have
+                # got there: resend everything next time
+                self._shadow.invalidate()
+                raise
+
+    def _instr_read(self, raw=False, size=None):
+        with Metrics.phase('io', 'VISA read'):
+            data = super()._instr_read(raw, size)
+        Metrics.count('visa_bytes_read', len(data))
+        return data
+
+    def write(self, msg, arg=None, *args, **kwargs):
+        if arg is None and not args and not kwargs:
+            # Drop the settings the instrument already has
+            msg = self._shadow.filter(msg)
+            if not msg:
+                return
+        else:
+            self._shadow.invalidate()
+        return super().write(msg, arg, *args, **kwargs)
         
     # --------------------------------------------------
     # Set functions
@@ -55,51 +126,60 @@ class SDG6022X(SCPI.SCPIDevice):
     def is_output_enabled(self, channel): 
         return 'OUTP ON' in self.ask(f"C{channel}:OUTP?")
     
+    @runs_live
     def upload_custom_waveform(self, name, waveform, channel=1):
         """
         Uploads a waveform to the Siglent AWG.
         Command: C1:WVDT WVNM,name,WAVEDATA,binary_block
+
+        The transfer is skipped if the same data was already uploaded under
+        this name on this channel.
         """
-        # Ensure data is float32
+        # Ensure data is float32 (no copy if it already is)
         waveform = np.asarray(waveform, dtype=np.float32)
-        payload = waveform.tobytes()
+        digest = WaveformCache.digest(waveform)
+        if self._wfm_cache.lookup(channel, name, digest):
+            self.write(f"C{channel}:ARWV NAME,{name}")
+            return
+        self._wfm_cache.invalidate(channel, name)
+        # ARWV must be sent again to pick up the new data
+        self._shadow.invalidate(channel)
         
-        # 1. Prepare Header
-        byte_count = len(payload)
-        len_str = str(byte_count)
-        # IEEE 488.2 Header: # + digits_in_length + length
-        header = f"#{len(len_str)}{len_str}".encode("ascii")
-        
-        # 2. Prepare Command String
+        # 1. Prepare Command String
         # Siglent uses C1, C2 etc.
         cmd_str = f"C{channel}:WVDT WVNM,{name},WAVEDATA,"
         cmd_bytes = cmd_str.encode("ascii")
         
-        # 3. Send Binary Block
-        # We write directly to the raw instrument to handle binary data safely
-        self.instr.instr.write_raw(cmd_bytes + header + payload)
+        # 2. Send Binary Block
+        # We write directly to the raw instrument to handle binary data safely;
+        # the IEEE 488.2 header is added and the payload is sent without copying
+        write_binary_block(self.instr.instr, cmd_bytes, waveform)
         self.write("*WAI")
+        # Only remembered as uploaded once the instrument took it without error
+        err = self.ask("SYST:ERR?")
+        if int(err.split(",", 1)[0]) != 0:
+            raise RuntimeError(f"Upload of waveform {name} to channel {channel} failed: {err}")
+        self._wfm_cache.store(channel, name, digest)
         
-        # 4. Select the uploaded wave
+        # 3. Select the uploaded wave
         self.write(f"C{channel}:ARWV NAME,{name}")
 
     def set_sample_rate(self, sample_rate, channel=1):
         """Sets sample rate in Sa/s"""
         self.write(f"C{channel}:BSWV SRATE,{sample_rate}")
 
-    def test_print(self, arg1, arg2, arg3):
-        print(f'Test print: {arg1, arg2, arg3}')
-
-
-@register_command
-def SDGTestFunc (instr : SDG6022X, arg1, arg2, arg3):
-    instr.test_print(arg1, arg2, arg3)
+    def get_waveform_cache_stats(self):
+        """Waveform cache hit/miss counters and resident waveforms, as JSON."""
+        return json.dumps(self._wfm_cache.stats())
 
+    @runs_live
+    def resync_state(self):
+        """Forget the shadowed settings so the next writes are all sent."""
+        self._shadow.invalidate()
 
-    
-@register_command
-def SDG_Set_Arb(instr, arg1, arg2):
-    instr.set_function(arg1)
-    
-
+    def get_shadow_stats(self):
+        """Number of suppressed writes and of shadowed settings, as JSON."""
+        return json.dumps(self._shadow.stats())
 
+    def test_print(self, arg1, arg2, arg3):
+        print(f'Test print: {arg1, arg2, arg3}')
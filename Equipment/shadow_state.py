@@ -0,0 +1,95 @@
+import re
+import threading
+
+from .visa_utils import root_scpi_message
+
+_CHANNEL_RE = re.compile(r'^[A-Za-z]+(\d+)')
+
+
+class ShadowState:
+    """
+    Last value written for every SCPI setting, per channel, so that settings
+    which wouldn't change anything can be dropped from outgoing messages.
+
+    A message is split into its ';'-separated units. Units of the form
+    'HEADER value' are settings; anything else (no value, a common '*'
+    command or a header matching one of the actions) is an event and is
+    always sent.
+
+    The shadow only knows what went through filter(): anything that changes
+    settings behind its back (*RST, front panel, an error from SYST:ERR?,
+    reconnects), or a write that failed after filter() recorded its
+    settings, must call invalidate().
+
+    param_pairs : bool
+        For 'HEADER NAME,value' style instruments (Siglent), use 'HEADER NAME'
+        as the setting key.
+    actions : list of regex
+        Headers that do something every time they are sent even though they
+        take a value (e.g. MMEM:LOAD), so are never suppressed.
+    resync_on : list of regex
+        Settings whose change makes the instrument re-derive others (e.g.
+        the waveform function); when one of them changes, everything else
+        cached for that channel is forgotten.
+    """
+
+    def __init__(self, param_pairs=False, actions=(), resync_on=()):
+        self._param_pairs = param_pairs
+        self._actions = [re.compile(p) for p in actions]
+        self._resync_on = [re.compile(p) for p in resync_on]
+        self._values = {}   # { channel (int or None): { key: value } }
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def _split(self, unit):
+        header, _, value = unit.lstrip(':').partition(' ')
+        value = value.strip()
+        if not value or header.startswith('*'):
+            return None, None, None
+        key = header.upper()
+        if any(p.match(key) for p in self._actions):
+            return None, None, None
+        if self._param_pairs and ',' in value:
+            name, _, value = value.partition(',')
+            key = f'{key} {name.upper()}'
+        match = _CHANNEL_RE.match(key)
+        channel = int(match.group(1)) if match else None
+        return channel, key, value
+
+    def filter(self, msg):
+        """Return msg without the settings that already have that value."""
+        units = [u.strip() for u in msg.split(';') if u.strip()]
+        kept = []
+        with self._lock:
+            for unit in units:
+                channel, key, value = self._split(unit)
+                if key is None:
+                    kept.append(unit)
+                    continue
+                settings = self._values.setdefault(channel, {})
+                if settings.get(key) == value:
+                    self.suppressed += 1
+                    continue
+                if key in settings and any(p.match(key) for p in self._resync_on):
+                    settings.clear()
+                settings[key] = value
+                kept.append(unit)
+
+        if len(kept) == len(units):
+            return msg
+        return ';'.join(root_scpi_message(u) for u in kept)
+
+    def invalidate(self, channel=None):
+        """Forget one channel's settings, or (default) everything."""
+        with self._lock:
+            if channel is None:
+                self._values.clear()
+            else:
+                self._values.pop(channel, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "suppressed": self.suppressed,
+                "settings": sum(len(v) for v in self._values.values()),
+            }
@@ -0,0 +1,148 @@
+"""
+Choosing the VISA transport of a LAN instrument.
+
+The same generator can usually be reached as
+    inst     VXI-11           TCPIP::host::INSTR
+    hislip   HiSLIP           TCPIP::host::hislip0::INSTR
+    socket   raw SCPI socket  TCPIP::host::5025::SOCKET
+with quite different round-trip times and bulk throughput. select_address()
+turns an address and a transport policy into the resource to open: one of
+the names above forces that transport on the address' host, 'auto' opens
+each of them, times a few short queries and one query answered with a
+binary block, and keeps the one with the lowest estimated time for a
+typical workload (WORKLOAD_COMMANDS round trips + WORKLOAD_BYTES of block
+data).
+"""
+import re
+import time
+import statistics
+
+import pyvisa
+
+TRANSPORTS = ('inst', 'hislip', 'socket')
+
+# Workload the transports are compared on: short commands and block bytes
+# (one 4M point DAC waveform)
+WORKLOAD_COMMANDS = 100
+WORKLOAD_BYTES = 8_000_000
+
+# Raw SCPI socket port when the address doesn't give one
+SOCKET_PORT = 5025
+
+_TCPIP_RE = re.compile(r'^TCPIP(\d*)::([^:]+)(?:::(.*))?$', re.IGNORECASE)
+
+
+def transport_of(addr):
+    """Transport of a VISA resource string ('inst', 'hislip', 'socket'), None if not TCPIP."""
+    match = _TCPIP_RE.match(addr.strip())
+    if match is None:
+        return None
+    rest = (match.group(3) or '').upper()
+    if rest.endswith('SOCKET'):
+        return 'socket'
+    if rest.startswith('HISLIP'):
+        return 'hislip'
+    return 'inst'
+
+
+def resource_name(addr, transport, socket_port=SOCKET_PORT):
+    """addr's host reached over transport (addr itself if it already uses it)."""
+    if transport not in TRANSPORTS:
+        raise ValueError(f"Unknown transport {transport!r}, expected one of {TRANSPORTS} or 'auto'")
+    if transport_of(addr) == transport:
+        return addr
+    match = _TCPIP_RE.match(addr.strip())
+    if match is None:
+        raise ValueError(f"Transport {transport!r} needs a TCPIP address, got {addr!r}")
+    board, host, _ = match.groups()
+    if transport == 'socket':
+        return f'TCPIP{board}::{host}::{socket_port}::SOCKET'
+    if transport == 'hislip':
+        return f'TCPIP{board}::{host}::hislip0::INSTR'
+    return f'TCPIP{board}::{host}::INSTR'
+
+
+def probe(resource, latency_query='*IDN?', bulk_query=None, repeats=5, timeout=2000, bulk_timeout=10000):
+    """
+    Open resource and time it: the median of repeats latency_query round
+    trips, and the throughput of bulk_query, whose reply is a binary block
+    (None to skip it). Returns {"latency": s, "bandwidth": bytes/s or None}.
+
+    The bulk reply also includes the time the instrument takes to produce
+    it, which is the same on every transport.
+    """
+    # Not closed: pyvisa shares one manager per library, the driver's included
+    rm = pyvisa.ResourceManager()
+    instr = rm.open_resource(resource, open_timeout=timeout)
+    try:
+        instr.timeout = timeout
+        if instr.resource_class == 'SOCKET':
+            # No END on a raw socket, messages end with a newline both ways
+            instr.read_termination = instr.write_termination = '\n'
+        # The first round trip also sets up the link
+        instr.query(latency_query)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            instr.query(latency_query)
+            times.append(time.perf_counter() - start)
+        latency = statistics.median(times)
+
+        bandwidth = None
+        if bulk_query is not None:
+            instr.timeout = bulk_timeout
+            start = time.perf_counter()
+            data = instr.query_binary_values(bulk_query, datatype='B', container=bytes)
+            elapsed = time.perf_counter() - start - latency
+            bandwidth = len(data) / max(elapsed, 1e-6)
+        return {"latency": latency, "bandwidth": bandwidth}
+    finally:
+        instr.close()
+
+
+def workload_time(result, commands=WORKLOAD_COMMANDS, nbytes=WORKLOAD_BYTES):
+    """Estimated seconds for the workload on a probed transport."""
+    seconds = commands * result["latency"]
+    if result["bandwidth"]:
+        seconds += nbytes / result["bandwidth"]
+    return seconds
+
+
+def select_address(addr, transport=None, latency_query='*IDN?', bulk_query=None,
+                   candidates=TRANSPORTS, socket_port=SOCKET_PORT):
+    """
+    The resource to open for addr under a transport policy, and the probe
+    results ({resource: result or error message}, empty unless 'auto').
+
+    transport : None, 'auto', 'inst', 'hislip' or 'socket'
+        None uses addr as it is. 'auto' only applies to TCPIP addresses
+        (others are used as they are); if no candidate answers, addr is
+        returned and opening it reports the error.
+    """
+    if transport is None:
+        return addr, {}
+    if transport != 'auto':
+        return resource_name(addr, transport, socket_port), {}
+    if transport_of(addr) is None:
+        return addr, {}
+
+    results = {}
+    for candidate in candidates:
+        resource = resource_name(addr, candidate, socket_port)
+        try:
+            results[resource] = probe(resource, latency_query, bulk_query)
+        except Exception as e:
+            # Connection refused, timeout, unsupported protocol...
+            results[resource] = f'{type(e).__name__}: {e}'
+            print(f'{resource}: not available ({results[resource]})')
+            continue
+        result = results[resource]
+        bandwidth = 'no bulk probe' if result["bandwidth"] is None else f'{result["bandwidth"] / 1e6:.1f} MB/s'
+        print(f'{resource}: {latency_query} {result["latency"] * 1e3:.2f} ms, {bandwidth}')
+
+    usable = {resource: result for resource, result in results.items() if isinstance(result, dict)}
+    if not usable:
+        return addr, results
+    best = min(usable, key=lambda resource: workload_time(usable[resource]))
+    print(f'Using {best}')
+    return best, results
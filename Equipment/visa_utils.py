@@ -0,0 +1,187 @@
+import time
+
+import numpy as np
+
+from core import Metrics
+
+
+def ieee_block_header(byte_count):
+    """IEEE 488.2 definite-length block header: # + digits_in_length + length"""
+    len_str = str(byte_count)
+    return f"#{len(len_str)}{len_str}".encode("ascii")
+
+
+def root_scpi_message(msg):
+    """
+    Make msg safe to follow a ';' in a compound SCPI message: strip the
+    trailing ';' and anchor the header at the root with ':' (common '*'
+    commands are left as they are).
+    """
+    msg = msg.strip().rstrip(';')
+    if msg and msg[0] not in ':*':
+        msg = ':' + msg
+    return msg
+
+
+# Program message terminator on raw SCPI sockets (TCPIP::host::port::SOCKET)
+SOCKET_TERMINATION = b"\n"
+
+
+def terminate_socket_writes(backend):
+    """
+    Make a pylablib VISA backend end its writes with a newline on SOCKET
+    resources. pylablib hands term_write to pyvisa, whose write_raw ignores
+    it; VXI-11/HiSLIP mark the end of a message with END, but a raw socket
+    instrument waits for the newline. Call again after reopening.
+    """
+    if getattr(getattr(backend, "instr", None), "resource_class", None) == "SOCKET":
+        backend.term_write = SOCKET_TERMINATION.decode()
+
+
+def _is_pyvisa_py(visa_instr):
+    return type(visa_instr.visalib).__module__.startswith("pyvisa_py")
+
+
+# pyvisa-py VXI-11 session attributes the gathered write relies on (not
+# public API: without any of them the write falls back to write_raw)
+_VXI11_SESSION_ATTRS = ("link", "max_recv_size", "_io_timeout", "lock_timeout", "interface")
+
+
+def _vxi11_session(visa_instr):
+    """Return the pyvisa-py VXI-11 session behind visa_instr, or None."""
+    sessions = getattr(visa_instr.visalib, "sessions", None) or {}
+    session = sessions.get(visa_instr.session)
+    if session is None or not all(hasattr(session, attr) for attr in _VXI11_SESSION_ATTRS):
+        return None
+    if not hasattr(session.interface, "device_write"):
+        return None
+    try:
+        from pyvisa_py.protocols.vxi11 import OP_FLAG_END  # noqa: F401
+    except ImportError:
+        return None
+    return session
+
+
+# Largest piece handed to a single VXI-11 device_write
+VXI11_WRITE_BLOCK = 1024 * 1024
+
+
+def _vxi11_gather_write(session, parts):
+    """
+    Send parts as one VXI-11 message: every device_write except the last one
+    goes out without the END flag, so the instrument sees a single message.
+
+    Parts are sliced as memoryviews; pyvisa-py's XDR packer only takes bytes
+    (and copies them into the RPC message), so each block is copied once
+    there, VXI11_WRITE_BLOCK bytes at most at a time. A device_write that
+    takes fewer bytes than offered, as VXI-11 allows, continues with the rest.
+    """
+    from pyvisa_py.protocols import vxi11
+
+    max_size = min(session.max_recv_size, VXI11_WRITE_BLOCK)
+    last = len(parts) - 1
+    for i, part in enumerate(parts):
+        part = memoryview(part).cast("B")
+        offset = 0
+        while offset < len(part):
+            block = part[offset : offset + max_size]
+            end = i == last and offset + len(block) == len(part)
+            error, size = session.interface.device_write(
+                session.link, session._io_timeout, session.lock_timeout,
+                vxi11.OP_FLAG_END if end else 0, bytes(block),
+            )
+            if error or size <= 0:
+                raise IOError(f"VXI-11 device_write failed (error {error}, {offset}/{len(part)} bytes)")
+            offset += size
+
+
+def write_binary_block(visa_instr, prefix, data, suffix=b""):
+    """
+    Write prefix + IEEE 488.2 definite-length block of data (+ suffix)
+    without building one concatenated copy of the payload.
+
+    data : array-like
+        Written as its raw (native) bytes; a C-contiguous array is sent
+        through a memoryview.
+
+    Raw sockets get the pieces as consecutive writes, pyvisa-py VXI-11 links
+    get them as device_write calls with END only on the last one. Other
+    transports/backends end the message on every write, so for those the
+    pieces are joined into a single buffer (one copy of the payload).
+    """
+    payload = memoryview(np.ascontiguousarray(data)).cast("B")
+    parts = [prefix + ieee_block_header(payload.nbytes), payload]
+    if visa_instr.resource_class == "SOCKET" and not suffix.endswith(SOCKET_TERMINATION):
+        # No END flag on a raw socket: the newline ends the message
+        suffix += SOCKET_TERMINATION
+    if suffix:
+        parts.append(suffix)
+    Metrics.count("visa_bytes_written", len(parts[0]) + payload.nbytes + len(suffix))
+
+    with Metrics.phase("io", "VISA block write", f"{prefix.decode('ascii', 'replace')}<{payload.nbytes} bytes>"):
+        _write_parts(visa_instr, parts)
+
+
+def _write_parts(visa_instr, parts):
+    if _is_pyvisa_py(visa_instr):
+        if visa_instr.resource_class == "SOCKET":
+            for part in parts:
+                visa_instr.write_raw(part)
+            return
+        session = _vxi11_session(visa_instr)
+        if session is not None:
+            _vxi11_gather_write(session, parts)
+            return
+
+    # Any other backend ends the message on every write: one joined buffer,
+    # which copies the payload once
+    visa_instr.write_raw(b"".join(parts))
+
+
+# Event status register (*ESR?) bits
+ESR_OPC = 1
+ESR_ERRORS = 4 | 8 | 16 | 32    # query, device, execution and command errors
+
+# Polling interval of wait_complete: short at first, so quick operations
+# return at once, then doubling, so long ones only cost a few queries
+COMPLETION_POLL_START = 0.001
+COMPLETION_POLL_MAX = 0.1
+
+# Used when the VISA session has no I/O timeout
+COMPLETION_TIMEOUT = 60.0
+
+
+def _poll_esr(device, deadline):
+    esr = int(device.ask("*ESR?"))
+    delay = COMPLETION_POLL_START
+    while not esr & ESR_OPC:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("*OPC not reported by *ESR?")
+        time.sleep(min(delay, remaining))
+        delay = min(2 * delay, COMPLETION_POLL_MAX)
+        Metrics.count("completion_polls")
+        esr |= int(device.ask("*ESR?"))
+    return esr
+
+
+def wait_complete(device, timeout=None, label="*OPC"):
+    """
+    Wait until the instrument has finished everything sent to it before,
+    and return its event status register (read with *ESR?, which clears it;
+    check ESR_ERRORS before asking SYST:ERR?).
+
+    Sends *OPC, whose OPC bit is set once the pending operations are done,
+    and polls *ESR? for it: first after COMPLETION_POLL_START seconds, then
+    twice as long each time, up to COMPLETION_POLL_MAX. (Service requests
+    would avoid the polling, but pyvisa-py, the backend used here, delivers
+    no VISA events.) Raises TimeoutError after timeout seconds (None: the
+    session's I/O timeout).
+    """
+    visa_instr = device.instr.instr
+    if timeout is None:
+        timeout = visa_instr.timeout / 1000 if visa_instr.timeout else COMPLETION_TIMEOUT
+    deadline = time.monotonic() + timeout
+    with Metrics.phase("wait", label):
+        device.write("*OPC")
+        return _poll_esr(device, deadline)
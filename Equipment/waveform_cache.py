@@ -0,0 +1,59 @@
+import hashlib
+import threading
+
+import numpy as np
+
+
+class WaveformCache:
+    """
+    Tracks which waveform content is resident in an instrument's volatile
+    memory, keyed by (channel, slot), so identical uploads can be skipped.
+
+    The cache only knows what this driver uploaded: anything that clears or
+    replaces instrument memory (clear commands, *RST, reconnects) must call
+    invalidate().
+    """
+
+    def __init__(self):
+        self._resident = {}     # {(channel, slot): digest}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(data):
+        """Content hash of the raw bytes of data."""
+        view = memoryview(np.ascontiguousarray(data)).cast("B")
+        return hashlib.blake2b(view, digest_size=16).hexdigest()
+
+    def lookup(self, channel, slot, digest):
+        """Return True (and count a hit) if digest is already in (channel, slot)."""
+        with self._lock:
+            if self._resident.get((channel, slot)) == digest:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def store(self, channel, slot, digest):
+        with self._lock:
+            self._resident[(channel, slot)] = digest
+
+    def invalidate(self, channel=None, slot=None):
+        """Forget one slot, one channel, or (default) everything."""
+        with self._lock:
+            if channel is None:
+                self._resident.clear()
+            elif slot is None:
+                for key in [k for k in self._resident if k[0] == channel]:
+                    del self._resident[key]
+            else:
+                self._resident.pop((channel, slot), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "resident": {f"{ch}:{slot}": d for (ch, slot), d in self._resident.items()},
+            }
@@ -0,0 +1,319 @@
+import contextlib
+import hashlib
+import itertools
+import os
+import queue
+import tempfile
+import threading
+
+import numpy as np
+
+from .waveform_synth import SharedWaveform, iter_chunks as iter_synth_chunks
+
+# File extensions treated as headerless little-endian int16 DAC samples
+RAW_INT16_EXTENSIONS = ('.bin', '.raw', '.i16', '.dat')
+
+# Number of text lines parsed per np.loadtxt call when streaming ASCII files
+TEXT_BLOCK_LINES = 256 * 1024
+
+# Column-major int16 copy of a multi-column text file, written next to it
+# (or in the temp directory if that isn't writable)
+COLUMNS_SIDECAR_SUFFIX = '.columns.npy'
+
+
+def _check_1d(waveform, source):
+    if waveform.ndim != 1:
+        raise ValueError(
+            f"Waveform data in '{source}' must be 1D, got shape {waveform.shape}."
+        )
+    return waveform
+
+
+def _iter_array_chunks(waveform, chunk_size):
+    for start in range(0, waveform.shape[0], chunk_size):
+        yield waveform[start : start + chunk_size]
+
+
+def _iter_text_chunks(f, chunk_size, source):
+    """
+    Parse 1D integer ASCII data from an open file in chunk_size blocks.
+    Only one chunk (plus one TEXT_BLOCK_LINES parse block) is held in memory.
+    """
+    while True:
+        chunk = np.empty(chunk_size, dtype=np.int32)
+        n = 0
+        while n < chunk_size:
+            lines = list(itertools.islice(f, min(TEXT_BLOCK_LINES, chunk_size - n)))
+            if not lines:
+                break
+            try:
+                values = np.loadtxt(lines, dtype=np.int32, ndmin=1)
+            except Exception as exc:
+                raise ValueError(
+                    f"Failed to load DAC waveform from '{source}'. "
+                    "File must contain 1D integer ASCII data "
+                    "(valid for DATA:ARB:DAC)."
+                ) from exc
+            if values.ndim != 1 or values.shape[0] > len(lines):
+                raise ValueError(
+                    f"Waveform data in '{source}' must be 1D (one value per line)."
+                )
+            chunk[n : n + values.shape[0]] = values
+            n += values.shape[0]
+
+        if n == 0:
+            return
+        yield chunk[:n]
+        if n < chunk_size:
+            return
+
+
+def iter_dac_chunks(data, chunk_size):
+    """
+    Yield a DAC waveform in blocks of at most chunk_size points.
+
+    data : str | PathLike | file object | array-like | dict | SharedWaveform
+        .npy files are memory-mapped (np.load(mmap_mode='r')).
+        Files with a RAW_INT16_EXTENSIONS suffix are memory-mapped as raw
+        little-endian int16.
+        Any other path, or an open file object, is parsed as 1D integer ASCII
+        text one chunk at a time.
+        Arrays are sliced without copying.
+        A dict is a waveform spec, synthesized one chunk at a time, and a
+        SharedWaveform gives views of its shared buffer as they are rendered
+        (see Equipment.waveform_synth).
+    """
+    if isinstance(data, dict):
+        yield from iter_synth_chunks(data, chunk_size)
+        return
+    if isinstance(data, SharedWaveform):
+        yield from data.chunks(chunk_size)
+        return
+
+    if hasattr(data, "read"):
+        yield from _iter_text_chunks(data, chunk_size, getattr(data, "name", data))
+        return
+
+    if isinstance(data, (str, os.PathLike)):
+        path = os.fspath(data)
+        ext = os.path.splitext(path)[1].lower()
+
+        if ext == '.npy':
+            waveform = _check_1d(np.load(path, mmap_mode='r'), path)
+        elif ext in RAW_INT16_EXTENSIONS:
+            if os.path.getsize(path) == 0:
+                return
+            waveform = np.memmap(path, dtype='<i2', mode='r')
+        else:
+            with open(path) as f:
+                yield from _iter_text_chunks(f, chunk_size, path)
+            return
+    else:
+        waveform = _check_1d(np.asarray(data), 'array')
+
+    yield from _iter_array_chunks(waveform, chunk_size)
+
+
+def read_waveform(data, max_points, truncate=False):
+    """
+    Return the samples of data (anything iter_dac_chunks accepts) as one
+    array. With truncate=True only the first max_points are read, otherwise
+    data holding more than max_points samples is an error.
+    """
+    chunks = iter_dac_chunks(data, max_points)
+    try:
+        waveform = next(chunks, None)
+        longer = not truncate and next(chunks, None) is not None
+    finally:
+        chunks.close()
+    if waveform is None:
+        raise ValueError(f"No waveform data in '{data}'.")
+    if longer:
+        raise ValueError(f"Waveform data in '{data}' is longer than {max_points} samples.")
+    return waveform
+
+
+def numbered_file(path, number):
+    """
+    Path of waveform number of a NAME_nn file set, given any path with the
+    set's name and suffix (e.g. 'wfms/NAME.txt' -> 'wfms/NAME_07.txt').
+    """
+    stem, ext = os.path.splitext(os.fspath(path))
+    stem = stem.rstrip('_')
+    candidates = [f"{stem}_{number:02d}{ext}", f"{stem}_{number}{ext}"]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(f"No waveform file {' or '.join(candidates)}")
+
+
+def _sidecar_paths(path):
+    path = os.path.abspath(os.fspath(path))
+    key = hashlib.blake2b(path.encode(), digest_size=8).hexdigest()
+    return [
+        path + COLUMNS_SIDECAR_SUFFIX,
+        os.path.join(tempfile.gettempdir(), f"{os.path.basename(path)}.{key}{COLUMNS_SIDECAR_SUFFIX}"),
+    ]
+
+
+def _is_data_line(line):
+    line = line.strip()
+    return bool(line) and not line.startswith('#')
+
+
+def _text_table_shape(path):
+    """(rows, columns, delimiter) of a text table, counting lines only."""
+    rows = 0
+    first = None
+    with open(path) as f:
+        for line in f:
+            if _is_data_line(line):
+                rows += 1
+                if first is None:
+                    first = line
+    if first is None:
+        raise ValueError(f"No waveform data in '{path}'.")
+    delimiter = ',' if ',' in first else None
+    return rows, len(first.split(delimiter)), delimiter
+
+
+def build_column_sidecar(path):
+    """
+    Parse a multi-column integer text file once into a column-major int16
+    .npy sidecar, so each column can later be memory-mapped as one
+    contiguous array. Returns the sidecar path.
+    """
+    path = os.fspath(path)
+    rows, columns, delimiter = _text_table_shape(path)
+
+    for sidecar in _sidecar_paths(path):
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(sidecar))
+        except OSError:
+            continue
+        os.close(fd)
+        try:
+            table = np.lib.format.open_memmap(
+                tmp, mode='w+', dtype='<i2', shape=(rows, columns), fortran_order=True
+            )
+            n = 0
+            with open(path) as f:
+                while True:
+                    lines = list(itertools.islice(f, TEXT_BLOCK_LINES))
+                    if not lines:
+                        break
+                    try:
+                        values = np.loadtxt(lines, dtype=np.int32, delimiter=delimiter, ndmin=2)
+                    except Exception as exc:
+                        raise ValueError(
+                            f"Failed to load DAC waveforms from '{path}'. "
+                            "File must contain integer ASCII columns."
+                        ) from exc
+                    if values.size == 0:
+                        continue
+                    if values.shape[1] != columns:
+                        raise ValueError(
+                            f"Waveform file '{path}' has rows with {values.shape[1]} "
+                            f"columns, expected {columns}."
+                        )
+                    np.clip(values, -32767, 32767, out=table[n : n + values.shape[0]], casting='unsafe')
+                    n += values.shape[0]
+            table.flush()
+            del table
+            os.replace(tmp, sidecar)
+            return sidecar
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+    raise OSError(f"Could not write a column sidecar for '{path}'")
+
+
+def column_sidecar(path):
+    """The up-to-date column sidecar of a text file, built if needed."""
+    mtime = os.path.getmtime(path)
+    for sidecar in _sidecar_paths(path):
+        if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= mtime:
+            return sidecar
+    return build_column_sidecar(path)
+
+
+def column_table(path):
+    """
+    A multi-column waveform file as a memory-mapped (samples, columns) array.
+
+    .npy files are mapped directly. Text files are parsed once into a column
+    sidecar (see build_column_sidecar), which is mapped instead.
+    """
+    path = os.fspath(path)
+    if os.path.splitext(path)[1].lower() == '.npy':
+        table = np.load(path, mmap_mode='r')
+    else:
+        table = np.load(column_sidecar(path), mmap_mode='r')
+    if table.ndim != 2:
+        raise ValueError(f"Waveform file '{path}' must be 2D (samples, columns), got shape {table.shape}.")
+    return table
+
+
+def load_column(path, column):
+    """One column (0 = first) of a multi-column waveform file, memory-mapped."""
+    table = column_table(path)
+    if not 0 <= column < table.shape[1]:
+        raise ValueError(f"Waveform file '{path}' has no column {column} ({table.shape[1]} columns).")
+    return table[:, column]
+
+
+def prefetch(iterable, depth=1):
+    """
+    Run iterable in a background thread, keeping up to depth items ready.
+    Exceptions raised by the producer are re-raised in the consumer.
+
+    Close the generator (e.g. with contextlib.closing) when the consumer may
+    stop early: the producer is then stopped and the items it queued dropped.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as exc:
+            put((done, exc))
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, exc = items.get()
+            if exc is not None:
+                raise exc
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        # A producer blocked in put() gives up within its 0.1 s timeout;
+        # then drop what it had queued
+        worker.join()
+        while True:
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                break
@@ -0,0 +1,423 @@
+"""
+DAC waveforms synthesized from a compact spec, so a client can send a few
+hundred bytes instead of a multi-million-point array or text file:
+
+    {"points": 13000000,
+     "sample_rate": 13000000,          # optional, default: points (1 s long)
+     "scale": "peak",                  # optional, see below
+     "components": [
+         {"type": "tone", "amplitude": 1, "frequency": 17},
+         {"type": "tone", "amplitude": 1, "frequency": 6, "phase": 90}]}
+
+Times are in seconds and frequencies in Hz at sample_rate; with the default
+sample_rate the waveform lasts 1 s, so frequencies are cycles per waveform.
+The components are added up:
+
+    tone       amplitude, frequency, phase (degrees, default 0)
+    chirp      amplitude, f0, f1, start (default 0), duration (default: to
+               the end), method 'linear' (default) or 'exponential', phase;
+               zero outside [start, start + duration)
+    pulses     amplitude (high level), low (default 0), period, width, delay
+               (default 0), rise/fall edge times (default 0, fall = rise),
+               count (default: until the end); width runs from the start of
+               the rising edge to the start of the falling one
+    piecewise  times, values, interpolation 'linear' (default) or 'step';
+               the first/last value is held before/after the breakpoints
+    dc         value
+
+scale turns the sum into DAC codes:
+    'peak'  (default) the largest |sample| becomes full scale
+            (agilent33600A.DAC_MAX);
+            costs a first pass over the waveform
+    'sum'   the sum of the components' peak levels becomes full scale
+    None    amplitudes are fractions of full scale; the sum is clipped
+
+Samples are computed chunk by chunk (BLOCK_POINTS at a time), so memory use
+doesn't depend on the waveform length; any range can be rendered on its own.
+
+Long waveforms (PARALLEL_MIN_POINTS and up) can instead be rendered by a
+pool of processes into one shared-memory int16 buffer (see use_pool() and
+SharedWaveform): each upload chunk is split in one segment per process, so
+the first chunk is ready in about 1/POOL_WORKERS of the single-core time,
+and the chunks are handed out as views of the buffer (nothing is copied).
+"""
+import contextlib
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Most ARB slots a spec can fill (64 MSa, a channel's memory with the MEM option):
+# long specs are uploaded in chunks of up to ARB_MAX_POINTS, one slot each
+SPEC_MAX_SLOTS = 16
+
+# Samples evaluated at once (float64 temporaries of a few MB)
+BLOCK_POINTS = 256 * 1024
+
+SCALES = ('peak', 'sum', None)
+
+# Processes rendering long waveforms (None: one per CPU) and the shortest
+# waveform worth sending to them
+POOL_WORKERS = None
+PARALLEL_MIN_POINTS = 2_000_000
+
+_REQUIRED = {
+    'tone': ('amplitude', 'frequency'),
+    'chirp': ('amplitude', 'f0', 'f1'),
+    'pulses': ('amplitude', 'period', 'width'),
+    'piecewise': ('times', 'values'),
+    'dc': ('value',),
+}
+
+
+def _tone(c, t, duration):
+    return c['amplitude'] * np.sin(2 * np.pi * c['frequency'] * t + math.radians(c.get('phase', 0.0)))
+
+
+def _chirp(c, t, duration):
+    start = c.get('start', 0.0)
+    length = c.get('duration', duration - start)
+    if length <= 0:
+        return np.zeros(t.shape)
+    tau = t - start
+    f0, f1 = c['f0'], c['f1']
+    if c.get('method', 'linear') == 'linear' or f0 == f1:
+        cycles = f0 * tau + (f1 - f0) / (2 * length) * tau ** 2
+    else:
+        rate = math.log(f1 / f0) / length
+        cycles = f0 * np.expm1(rate * tau) / rate
+    y = c['amplitude'] * np.sin(2 * np.pi * cycles + math.radians(c.get('phase', 0.0)))
+    y[(tau < 0) | (tau >= length)] = 0.0
+    return y
+
+
+def _pulses(c, t, duration):
+    period, width = c['period'], c['width']
+    rise = c.get('rise', 0.0)
+    fall = c.get('fall', rise)
+    tau = t - c.get('delay', 0.0)
+    phase = np.mod(tau, period)
+    up = np.clip(phase / rise, 0.0, 1.0) if rise else np.ones_like(phase)
+    down = np.clip((width + fall - phase) / fall, 0.0, 1.0) if fall else (phase < width).astype(float)
+    level = np.minimum(up, down)
+    level[tau < 0] = 0.0
+    count = c.get('count')
+    if count is not None:
+        level[tau >= count * period] = 0.0
+    low = c.get('low', 0.0)
+    return low + (c['amplitude'] - low) * level
+
+
+def _piecewise(c, t, duration):
+    times = np.asarray(c['times'], dtype=float)
+    values = np.asarray(c['values'], dtype=float)
+    if c.get('interpolation', 'linear') == 'linear':
+        return np.interp(t, times, values)
+    index = np.searchsorted(times, t, side='right') - 1
+    return values[np.clip(index, 0, len(values) - 1)]
+
+
+def _dc(c, t, duration):
+    return np.full(t.shape, float(c['value']))
+
+
+_COMPONENTS = {
+    'tone': _tone,
+    'chirp': _chirp,
+    'pulses': _pulses,
+    'piecewise': _piecewise,
+    'dc': _dc,
+}
+
+
+def _component_peak(c):
+    """Largest |level| a component can reach (for scale='sum')."""
+    kind = c['type']
+    if kind == 'pulses':
+        return max(abs(c['amplitude']), abs(c.get('low', 0.0)))
+    if kind == 'piecewise':
+        return float(np.max(np.abs(c['values'])))
+    if kind == 'dc':
+        return abs(c['value'])
+    return abs(c['amplitude'])
+
+
+def _check_component(i, c):
+    if not isinstance(c, dict) or c.get('type') not in _COMPONENTS:
+        raise ValueError(f"Component {i}: type must be one of {list(_COMPONENTS)}, got {c!r}")
+    missing = [key for key in _REQUIRED[c['type']] if key not in c]
+    if missing:
+        raise ValueError(f"Component {i} ({c['type']}) is missing {', '.join(missing)}")
+    kind = c['type']
+    if kind == 'chirp':
+        if c.get('method', 'linear') not in ('linear', 'exponential'):
+            raise ValueError(f"Component {i}: chirp method must be 'linear' or 'exponential'")
+        if c.get('method') == 'exponential' and (c['f0'] <= 0 or c['f1'] <= 0):
+            raise ValueError(f"Component {i}: an exponential chirp needs f0, f1 > 0")
+        if c.get('duration', 1.0) <= 0:
+            raise ValueError(f"Component {i}: chirp duration must be > 0")
+    elif kind == 'pulses':
+        if c['period'] <= 0 or not 0 <= c['width'] <= c['period']:
+            raise ValueError(f"Component {i}: pulses need period > 0 and 0 <= width <= period")
+    elif kind == 'piecewise':
+        times, values = np.asarray(c['times'], dtype=float), np.asarray(c['values'], dtype=float)
+        if times.ndim != 1 or times.shape != values.shape or len(times) == 0:
+            raise ValueError(f"Component {i}: piecewise times and values must be equal-length lists")
+        if np.any(np.diff(times) < 0):
+            raise ValueError(f"Component {i}: piecewise times must be increasing")
+        if c.get('interpolation', 'linear') not in ('linear', 'step'):
+            raise ValueError(f"Component {i}: piecewise interpolation must be 'linear' or 'step'")
+
+
+class _Prepared(dict):
+    """A checked spec with its defaults and scale resolved."""
+
+
+def _check(spec):
+    """The checked spec with its defaults resolved (factor still 1), and its scale."""
+    # Imported here: the pool's processes only get prepared specs and never
+    # load the driver (nor pylablib behind it)
+    from .agilent33600A import DAC_MAX, ARB_MAX_POINTS
+    points = int(spec.get('points', 0))
+    if points < 1:
+        raise ValueError(f"Waveform spec needs points >= 1, got {spec.get('points')!r}")
+    if points > SPEC_MAX_SLOTS * ARB_MAX_POINTS:
+        raise ValueError(f"Waveform spec has {points} points, at most {SPEC_MAX_SLOTS} ARB slots "
+                         f"of {ARB_MAX_POINTS} ({SPEC_MAX_SLOTS * ARB_MAX_POINTS}) can be uploaded")
+    sample_rate = float(spec.get('sample_rate', points))
+    if sample_rate <= 0:
+        raise ValueError(f"sample_rate must be > 0, got {sample_rate}")
+    components = spec.get('components')
+    if not components:
+        raise ValueError("Waveform spec needs a non-empty components list")
+    for i, c in enumerate(components):
+        _check_component(i, c)
+    scale = spec.get('scale', 'peak')
+    if scale not in SCALES:
+        raise ValueError(f"scale must be one of {SCALES}, got {scale!r}")
+    return _Prepared(points=points, sample_rate=sample_rate, components=components, factor=1.0,
+                     full_scale=DAC_MAX), scale
+
+
+def _scaled(prepared, scale, top=None):
+    """prepared with its factor set; top is the peak for scale='peak'."""
+    if scale is None:
+        prepared['factor'] = float(prepared['full_scale'])
+        return prepared
+    if scale == 'sum':
+        top = sum(map(_component_peak, prepared['components']))
+    prepared['factor'] = prepared['full_scale'] / top if top > 0 else 0.0
+    return prepared
+
+
+def prepare(spec):
+    """
+    Check a spec and resolve its defaults and scale; returns the dict that
+    render() takes ("factor" is the float -> DAC code multiplier, "full_scale"
+    the largest DAC code).
+    A prepared spec is returned as it is.
+    """
+    if isinstance(spec, _Prepared):
+        return spec
+    prepared, scale = _check(spec)
+    return _scaled(prepared, scale, peak(prepared) if scale == 'peak' else None)
+
+
+def _evaluate(prepared, start, stop):
+    """Sum of the components over samples start..stop-1, before scaling."""
+    sample_rate = prepared['sample_rate']
+    duration = prepared['points'] / sample_rate
+    t = np.arange(start, stop, dtype=float) / sample_rate
+    y = np.zeros(stop - start)
+    for c in prepared['components']:
+        y += _COMPONENTS[c['type']](c, t, duration)
+    return y
+
+
+def peak(prepared, start=0, stop=None):
+    """Largest |sum of the components| over samples start..stop-1."""
+    stop = prepared['points'] if stop is None else stop
+    top = 0.0
+    for block_start in range(start, stop, BLOCK_POINTS):
+        y = _evaluate(prepared, block_start, min(block_start + BLOCK_POINTS, stop))
+        top = max(top, float(np.max(np.abs(y), initial=0.0)))
+    return top
+
+
+def render(spec, start=0, stop=None, out=None):
+    """
+    DAC codes (int16, rounded and clipped to +-full scale) of samples
+    start..stop-1, written into out if given (an int16 array of that length).
+    """
+    prepared = prepare(spec)
+    stop = prepared['points'] if stop is None else min(stop, prepared['points'])
+    if out is None:
+        out = np.empty(stop - start, dtype='<i2')
+    elif len(out) != stop - start:
+        raise ValueError(f"out has {len(out)} samples for the range {start}..{stop}")
+    for block_start in range(start, stop, BLOCK_POINTS):
+        block_stop = min(block_start + BLOCK_POINTS, stop)
+        y = _evaluate(prepared, block_start, block_stop)
+        y *= prepared['factor']
+        np.rint(y, out=y)
+        np.clip(y, -prepared['full_scale'], prepared['full_scale'], out=out[block_start - start:block_stop - start], casting='unsafe')
+    return out
+
+
+def iter_chunks(spec, chunk_size):
+    """Yield the DAC codes of a spec in int16 blocks of at most chunk_size points."""
+    prepared = prepare(spec)
+    for start in range(0, prepared['points'], chunk_size):
+        yield render(prepared, start, start + chunk_size)
+
+
+# ---------------------------------------------------------------------------
+# Process pool rendering into shared memory
+# ---------------------------------------------------------------------------
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _workers():
+    return POOL_WORKERS or os.cpu_count() or 1
+
+
+def _get_pool():
+    """The rendering processes, started on first use and kept for later waveforms."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: the server is multi-threaded, forking it isn't safe
+            _pool = ProcessPoolExecutor(_workers(), mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def _attach(name):
+    """Runs in a pool process: open the shared block name without taking ownership."""
+    try:
+        # Python 3.13+: the parent owns (and unlinks) the block
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Before 3.13 attaching registers the block with the resource tracker.
+    # The pool's processes share the parent's tracker, so unregistering
+    # afterwards would drop the parent's own registration: skip it instead
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _peak_segment(prepared, start, stop):
+    """Runs in a pool process."""
+    return peak(prepared, start, stop)
+
+
+def _render_segment(prepared, start, stop, name):
+    """Runs in a pool process: render samples start..stop-1 into the shared block name."""
+    shm = _attach(name)
+    try:
+        samples = np.ndarray(prepared['points'], dtype='<i2', buffer=shm.buf)
+        render(prepared, start, stop, samples[start:stop])
+        del samples
+    finally:
+        shm.close()
+
+
+def _segments(points, chunk_size, parts):
+    """(start, stop) of each segment: every chunk_size chunk split in parts."""
+    bounds = []
+    for chunk_start in range(0, points, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, points)
+        step = max(BLOCK_POINTS, -(-(chunk_stop - chunk_start) // parts))
+        bounds += [(start, min(start + step, chunk_stop)) for start in range(chunk_start, chunk_stop, step)]
+    return bounds
+
+
+class SharedWaveform:
+    """
+    A spec rendered by the process pool into a shared-memory int16 buffer.
+
+    Rendering starts on creation, segments in order; chunks() hands out
+    each chunk as soon as its segments are done, as a view of the buffer.
+    Use it as a context manager (or call close()) to free the buffer once
+    the chunks have been used.
+
+        with SharedWaveform(spec, chunk_size) as waveform:
+            for chunk in waveform.chunks(chunk_size):
+                ...
+    """
+
+    def __init__(self, spec, chunk_size=4_000_000):
+        prepared, scale = _check(spec)
+        pool = _get_pool()
+        points = prepared['points']
+        bounds = _segments(points, chunk_size, _workers())
+        top = None
+        if scale == 'peak':
+            top = max(pool.map(_peak_segment, *zip(*[(prepared, a, b) for a, b in bounds])))
+        self.prepared = _scaled(prepared, scale, top)
+
+        self._shm = SharedMemory(create=True, size=2 * points)
+        self.samples = np.ndarray(points, dtype='<i2', buffer=self._shm.buf)
+        self._segments = [
+            (a, b, pool.submit(_render_segment, self.prepared, a, b, self._shm.name)) for a, b in bounds
+        ]
+
+    def __len__(self):
+        return self.prepared['points']
+
+    def chunks(self, chunk_size):
+        """Yield views of chunk_size samples at a time, each one once it is rendered."""
+        pending = iter(self._segments)
+        done = 0
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            while done < stop:
+                _, done, future = next(pending)
+                # Re-raises what went wrong in the pool process
+                future.result()
+            yield self.samples[start:stop]
+
+    def close(self):
+        for _, _, future in self._segments:
+            future.cancel()
+        # Don't free the block under a process still writing into it
+        for _, _, future in self._segments:
+            if not future.cancelled():
+                future.exception()
+        self.samples = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # A chunk is still referenced (e.g. an aborted upload): the
+            # mapping goes away with it
+            pass
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def use_pool(spec):
+    """True if spec is long enough, and the machine has the cores, to render it with the pool."""
+    return int(spec.get('points', 0)) >= PARALLEL_MIN_POINTS and _workers() > 1
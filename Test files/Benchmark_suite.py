@@ -0,0 +1,413 @@
+#
+#   Benchmarks of the ZMQ server against simulated instruments
+#   (Instrument_simulator.py), written to a JSON file so runs can be compared
+#   between releases:
+#
+#     - p50/p99 round-trip latency of each A33* command (one REQ client)
+#     - commands/second with 1..N concurrent clients
+#     - load_split_and_upload_dac throughput (MB/s) vs chunk size
+#     - peak RSS of the server process during 4M/16M/64M-point uploads
+#
+#   The simulators and the server (set up like main.py) run as separate
+#   processes, so the numbers include the real ZMQ and VISA socket hops.
+#
+#   python "Test files/Benchmark_suite.py" --output benchmark_results.json
+#   python "Test files/Benchmark_suite.py" --quick
+#
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import zmq
+
+HERE = Path(__file__).resolve().parent
+ROOT = HERE.parent
+SIMULATOR = HERE / 'Instrument_simulator.py'
+
+# One call of each A33 command; value alternates between two settings so
+# the shadow state doesn't drop the repeated writes
+A33_COMMANDS = {
+    'A33ConfigureWFM': lambda i: dict(channel=1, waveform=0, amplitude=1.0 + i % 2, dc_offset=0.0,
+                                      frequency_bw_bitrate=1e3, phase=0.0),
+    'A33ConfigurePulse': lambda i: dict(channel=1, pulse_period=1e-3, pulse_width=1e-4 * (1 + i % 2),
+                                        leading_edge=1e-8, trailing_edge=1e-8),
+    'A33ConfigureARB': lambda i: dict(channel=2, arb_number=1, amplitude=1.0 + i % 2, f_sr_p_key=1, phase=0.0,
+                                      filter_key=2, dc_offset=0.0, advance_mode=False,
+                                      freq_sample_rate_period=1e6),
+    'A33ConfigureTrigger': lambda i: dict(channel=1, trigger_source=3, trigger_slope=0, delay=1e-6 * (i % 2),
+                                          int_period=1e-3, trigger_level=1.0),
+    'A33ConfigureBurst': lambda i: dict(channel=1, burst_mode=False, burst_phase=0.0, burst_count=1 + i % 2,
+                                        gate_polarity=False, internal_period=1e-3, enable_burst=True),
+    'A33OutputOnOff': lambda i: dict(channel=1, enable_output=bool(i % 2), output_mode=False, polarity=False,
+                                     impedance=50.0),
+    'A33ConfigureAM': lambda i: dict(channel=1, am_source=0, modulation_waveform=0, modulation_frequency=100.0,
+                                     enable_carrier_suppression=False, enable_amplitude_modulation=True,
+                                     modulation_depth=50.0 + i % 2),
+    'A33ConfigureFM': lambda i: dict(channel=1, enable_frequency_modulation=True, fm_source=0,
+                                     modulation_waveform=0, modulation_deviation=10.0 + i % 2,
+                                     modulation_frequency=100.0),
+    'A33ConfigureFSweep': lambda i: dict(channel=1, enable_frequency_sweep=True, sweep_spacing=0, sweep_time=1.0,
+                                         hold_time=0.0, return_time=0.0, start_frequency=100.0,
+                                         stop_frequency=1e3 + i % 2),
+    'A33PhaseSync': lambda i: {},
+    'A33ArbPhaseSync': lambda i: {},
+    'A33Trg': lambda i: {},
+    'A33ReadError': lambda i: {},
+}
+
+MB = 1024 * 1024
+
+
+# ---------------------------------------------------------------------------
+# Processes
+# ---------------------------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'nothing listening on port {port}')
+
+
+def start_simulator(args):
+    port = free_port()
+    proc = subprocess.Popen([
+        sys.executable, str(SIMULATOR), '--port', str(port),
+        '--arb-memory', str(args.arb_memory), '--max-arb-points', str(max(args.chunk_sizes)),
+        '--byte-latency', str(args.byte_latency), '--command-latency', str(args.command_latency),
+    ])
+    wait_for_port(port)
+    return proc, f'TCPIP::127.0.0.1::{port}::SOCKET'
+
+
+def start_server(address, device_addresses, fast):
+    cmd = [sys.executable, str(Path(__file__).resolve()), '--serve', address]
+    for name, addr in device_addresses.items():
+        cmd += ['--device', f'{name}={addr}']
+    if fast:
+        cmd.append('--fast')
+    return subprocess.Popen(cmd, cwd=ROOT)
+
+
+def run_server(address, devices_arg, fast):
+    """Child process: register the devices and serve, like main.py."""
+    sys.path.insert(0, str(ROOT))
+    from contextlib import ExitStack
+    from core.Server import serve
+    from core import register_device
+    from Equipment import Agilent33600A
+
+    with ExitStack() as stack:
+        for spec in devices_arg:
+            name, addr = spec.split('=', 1)
+            register_device(name, stack.enter_context(Agilent33600A(addr)), fast=fast)
+        context = stack.enter_context(zmq.Context())
+        try:
+            serve(context, address)
+        except KeyboardInterrupt:
+            pass
+
+
+def rss_bytes(pid):
+    """Current resident set size of process pid (None if it can't be read)."""
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+class PeakRSS:
+    """Samples the RSS of a process in the background, keeping the maximum."""
+
+    def __init__(self, pid, interval=0.005):
+        self.pid = pid
+        self.interval = interval
+        self.peak = self.start = rss_bytes(pid)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = rss_bytes(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# ---------------------------------------------------------------------------
+# Client
+# ---------------------------------------------------------------------------
+
+class Client:
+    def __init__(self, context, address, timeout_ms=600_000):
+        self.sock = context.socket(zmq.REQ)
+        self.sock.setsockopt(zmq.RCVTIMEO, timeout_ms)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.connect(address)
+
+    def call(self, cmd, instr=None, **kwargs):
+        message = dict(kwargs, cmd=cmd)
+        if instr is not None:
+            message['instr'] = instr
+        self.sock.send_string(json.dumps(message))
+        reply = self.sock.recv_string()
+        if reply.startswith('JOB '):
+            self.sock.send_string(json.dumps({'cmd': 'job_result', 'job_id': reply.split()[1]}))
+            reply = self.sock.recv_string()
+        if reply.startswith('ERROR'):
+            raise RuntimeError(f'{cmd}: {reply}')
+        return reply
+
+    def close(self):
+        self.sock.close()
+
+
+def percentiles(samples_ns):
+    us = np.asarray(samples_ns) / 1e3
+    return {
+        'n': len(us),
+        'p50_us': float(np.percentile(us, 50)),
+        'p99_us': float(np.percentile(us, 99)),
+        'mean_us': float(us.mean()),
+        'max_us': float(us.max()),
+    }
+
+
+def bench_latency(client, instr, n, warmup=20):
+    results = {}
+    for cmd, make_args in A33_COMMANDS.items():
+        for i in range(warmup):
+            client.call(cmd, instr, **make_args(i))
+        samples = []
+        for i in range(n):
+            kwargs = make_args(i)
+            start = time.perf_counter_ns()
+            client.call(cmd, instr, **kwargs)
+            samples.append(time.perf_counter_ns() - start)
+        results[cmd] = percentiles(samples)
+        print(f"  {cmd:22s} p50 {results[cmd]['p50_us']:8.0f} us   p99 {results[cmd]['p99_us']:8.0f} us")
+    return results
+
+
+def bench_concurrency(context, address, instrs, client_counts, duration):
+    results = {}
+    for n_clients in client_counts:
+        counts = [0] * n_clients
+        stop = threading.Event()
+        barrier = threading.Barrier(n_clients + 1)
+
+        def worker(k):
+            client = Client(context, address)
+            instr = instrs[k % len(instrs)]
+            make_args = A33_COMMANDS['A33ConfigureWFM']
+            barrier.wait()
+            i = 0
+            while not stop.is_set():
+                client.call('A33ConfigureWFM', instr, **make_args(i))
+                i += 1
+            counts[k] = i
+            client.close()
+
+        threads = [threading.Thread(target=worker, args=(k,)) for k in range(n_clients)]
+        for t in threads:
+            t.start()
+        barrier.wait()
+        start = time.perf_counter()
+        time.sleep(duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        results[str(n_clients)] = {'commands': sum(counts), 'commands_per_s': sum(counts) / elapsed}
+        print(f'  {n_clients:2d} clients: {sum(counts) / elapsed:10.0f} commands/s')
+    return results
+
+
+def make_waveform_file(directory, points):
+    """A .npy int16 waveform of points samples (memory-mapped by the driver)."""
+    path = Path(directory) / f'wfm_{points}.npy'
+    if not path.exists():
+        data = np.lib.format.open_memmap(path, mode='w+', dtype='<i2', shape=(points,))
+        block = 1 << 20
+        for start in range(0, points, block):
+            n = min(block, points - start)
+            data[start:start + n] = (np.arange(start, start + n) % 2000 - 1000) * 30
+        data.flush()
+        del data
+    return str(path)
+
+
+def upload(client, instr, path, points, chunk_size, server_pid):
+    client.call('A33ClearArbitrary', instr, channel=1)
+    with PeakRSS(server_pid) as rss:
+        start = time.perf_counter()
+        client.call('load_split_and_upload_dac', instr, data=path, arb_start_index=1, channel=1,
+                    chunk_size=chunk_size)
+        elapsed = time.perf_counter() - start
+    result = {
+        'points': points,
+        'chunk_size': chunk_size,
+        'seconds': elapsed,
+        'MB_per_s': points * 2 / MB / elapsed,
+    }
+    if rss.peak is not None:
+        result['rss_before_MB'] = rss.start / MB
+        result['rss_peak_MB'] = rss.peak / MB
+    return result
+
+
+def wait_for_server(context, address, instr, timeout=60):
+    """A client, once the server answers (the devices are registered by then)."""
+    deadline = time.monotonic() + timeout
+    while True:
+        client = Client(context, address, timeout_ms=1000)
+        try:
+            client.call('A33ReadError', instr)
+        except zmq.Again:
+            # A REQ socket can't send again after an unanswered request
+            client.close()
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'server at {address} did not answer') from None
+            continue
+        client.close()
+        return Client(context, address)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    simulators = [start_simulator(args) for _ in range(args.devices)]
+    device_addresses = {f'AG33600A_Sim{k + 1}': addr for k, (_, addr) in enumerate(simulators)}
+    instrs = list(device_addresses)
+    address = f'tcp://127.0.0.1:{free_port()}'
+    server = start_server(address, device_addresses, args.fast)
+    context = zmq.Context()
+    client = None
+    results = {
+        'meta': {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'options': {k: v for k, v in vars(args).items() if k not in ('serve', 'device')},
+        },
+    }
+    try:
+        client = wait_for_server(context, address, instrs[0])
+        # ARB1 on channel 2, for A33ConfigureARB
+        for instr in instrs:
+            client.call('A33LoadArbitraryVolat', instr, channel=2, arb_number=1, wfm_source=2,
+                        array_wfm=list(np.sin(np.linspace(0, 2 * np.pi, 1000))), job=False)
+
+        print(f'Round-trip latency ({args.n} calls each):')
+        results['latency'] = bench_latency(client, instrs[0], args.n)
+
+        print(f'Throughput ({args.duration:g} s per point, {len(instrs)} device(s)):')
+        results['concurrency'] = bench_concurrency(context, address, instrs, args.clients, args.duration)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            print(f'Upload throughput vs chunk size ({args.throughput_points} points):')
+            path = make_waveform_file(tmp, args.throughput_points)
+            results['upload_throughput'] = []
+            for chunk_size in args.chunk_sizes:
+                r = upload(client, instrs[0], path, args.throughput_points, chunk_size, server.pid)
+                results['upload_throughput'].append(r)
+                print(f"  chunk {chunk_size:10d}: {r['MB_per_s']:8.1f} MB/s")
+
+            print('Peak server RSS during uploads:')
+            results['upload_memory'] = []
+            for points in args.upload_sizes:
+                path = make_waveform_file(tmp, points)
+                r = upload(client, instrs[0], path, points, args.memory_chunk_size, server.pid)
+                results['upload_memory'].append(r)
+                if 'rss_peak_MB' in r:
+                    print(f"  {points:10d} points: peak {r['rss_peak_MB']:8.1f} MB "
+                          f"(+{r['rss_peak_MB'] - r['rss_before_MB']:.1f} MB), {r['MB_per_s']:.1f} MB/s")
+                else:
+                    print(f"  {points:10d} points: RSS not available, {r['MB_per_s']:.1f} MB/s")
+    finally:
+        if client is not None:
+            client.close()
+        context.term()
+        for proc in [server] + [p for p, _ in simulators]:
+            proc.terminate()
+            proc.wait()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Server and upload benchmarks against simulated instruments')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--quick', action='store_true', help='small sizes, for a smoke test')
+    parser.add_argument('--n', type=int, default=1000, help='calls per command for the latency benchmark')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per concurrency point')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--devices', type=int, default=2, help='simulated generators')
+    parser.add_argument('--fast', action='store_true', help='register the devices with fast dispatch')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[250_000, 1_000_000, 4_000_000, 16_000_000])
+    parser.add_argument('--throughput-points', type=int, default=16_000_000)
+    parser.add_argument('--upload-sizes', type=int, nargs='+', default=[4_000_000, 16_000_000, 64_000_000])
+    parser.add_argument('--memory-chunk-size', type=int, default=4_000_000)
+    parser.add_argument('--arb-memory', type=int, default=64_000_000, help='simulated volatile memory per channel')
+    parser.add_argument('--byte-latency', type=float, default=0.0, help='simulated seconds per byte of block data')
+    parser.add_argument('--command-latency', type=float, default=0.0, help='simulated seconds per message')
+    # Internal: run as the server process
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--device', action='append', default=[], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args.serve, args.device, args.fast)
+    else:
+        if args.quick:
+            args.n, args.duration, args.clients = 100, 0.5, [1, 4]
+            args.chunk_sizes = [250_000, 1_000_000]
+            args.throughput_points = 2_000_000
+            args.upload_sizes = [1_000_000, 4_000_000]
+            args.memory_chunk_size = 1_000_000
+        main(args)
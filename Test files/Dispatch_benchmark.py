@@ -0,0 +1,93 @@
+#
+#   Commands/second through the server dispatch path, without hardware.
+#   Compares the old per-call lookup (devices[instr].commands[cmd] with
+#   validate_call on every call) with the precompiled table in normal and
+#   fast (trusted) mode.
+#
+#   python "Test files/Dispatch_benchmark.py"
+#
+
+import sys
+import json
+import time
+from pathlib import Path
+from typing import Literal, Annotated
+from pydantic import validate_call, Field
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from core import devices, register_device, get_public_commands, Dispatch
+from core.Server import handle_tcp
+
+N = 50_000
+ChannelType = Literal[1, 2]
+
+
+class FakeAWG:
+    """Same kind of commands as Agilent33600A, with writes going nowhere."""
+
+    def __init__(self):
+        self.sent = 0
+        self.commands = get_public_commands(self)
+
+    def ask(self, msg):
+        return 'FAKE,AWG,0,0'
+
+    def write(self, msg):
+        self.sent += 1
+
+    @validate_call
+    def A33ConfigureWFM(
+        self,
+        channel: ChannelType,
+        waveform: Annotated[int, Field(ge=0, le=7)],
+        amplitude: Annotated[float, Field(ge=0)],
+        dc_offset: float,
+        frequency_bw_bitrate: Annotated[float, Field(gt=0)],
+        phase: Annotated[float, Field(ge=-360, le=360)]
+    ):
+        self.write(f":SOUR{channel}:FUNC {waveform};:SOUR{channel}:VOLT {amplitude:#.16g};")
+
+    @validate_call
+    def A33Trg(self):
+        self.write('*TRG;')
+
+
+def old_handle_tcp(message):
+    # core.Server.handle_tcp before the dispatch table
+    message_json = json.loads(message)
+    cmd = message_json.pop('cmd')
+    instr = message_json.pop('instr', None)
+    result_msg = devices[instr].commands[cmd](**message_json)
+    if result_msg is None:
+        return 'Operation complete'
+    return result_msg
+
+
+def rate(handler, messages, repeats=3):
+    """Best of repeats, in commands/second."""
+    best = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for i in range(N):
+            handler(messages[i % len(messages)])
+        best = max(best, N / (time.perf_counter() - start))
+    return best
+
+
+if __name__ == '__main__':
+    wfm = [
+        json.dumps({'instr': 'AWG', 'cmd': 'A33ConfigureWFM', 'channel': 1, 'waveform': 0,
+                    'amplitude': 1.0 + 0.5 * i, 'dc_offset': 0.0, 'frequency_bw_bitrate': 1e3,
+                    'phase': 0.0})
+        for i in range(8)
+    ]
+    trg = [json.dumps({'instr': 'AWG', 'cmd': 'A33Trg'})]
+
+    for name, messages in [('A33ConfigureWFM', wfm), ('A33Trg', trg)]:
+        register_device('AWG', FakeAWG())
+        before = rate(old_handle_tcp, messages)
+        normal = rate(handle_tcp, messages)
+        register_device('AWG', FakeAWG(), fast=True)
+        fast = rate(handle_tcp, messages)
+        print(f'{name:16s} old {before:10.0f}/s   table {normal:10.0f}/s   fast {fast:10.0f}/s'
+              f'   (x{fast / before:.1f})')
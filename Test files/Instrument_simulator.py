@@ -0,0 +1,558 @@
+#
+#   Simulated Keysight 33600A / Siglent SDG6022X on a raw SCPI socket, so the
+#   drivers (and the ZMQ server) can run without hardware:
+#
+#       python "Test files/Instrument_simulator.py" --model 33600a --port 5025
+#       Agilent33600A("TCPIP::127.0.0.1::5025::SOCKET")
+#
+#   Messages are '\n' terminated, ';' separated program units; IEEE 488.2
+#   definite-length blocks (#<n><length><data>) are read as raw bytes, so the
+#   ARB uploads go through the same path as on the instrument.
+#
+#   Each channel keeps its settings (queries return the last value set), the
+#   ARB waveforms loaded into its volatile memory and their total size.
+#   *IDN?, *OPC?, *OPC, *ESR?, *ESE, *SRE, *STB?, *CLS, *RST and SYST:ERR?
+#   behave as on the instrument; errors go into the error queue and set the
+#   matching *ESR? bit. The 33600A answers HCOP:SDUM:DATA? with a dummy
+#   screen image block (for the transport probe) and takes DATA:SEQ sequences
+#   over the waveforms in volatile memory.
+#
+#   --byte-latency models the link/instrument throughput (seconds per byte
+#   of binary block data), --command-latency the per-message handling time,
+#   --arb-memory the volatile memory per channel and --max-arb-points the
+#   longest single waveform.
+#
+#   Units after a ';' are treated as rooted at ':' (the drivers always send
+#   them like that, see visa_utils.root_scpi_message).
+#
+
+import re
+import abc
+import time
+import socket
+import hashlib
+import argparse
+import threading
+import socketserver
+
+import numpy as np
+
+MAX_ERRORS = 20
+
+# *ESR? bits
+ESR_OPC = 1
+ESR_QUERY_ERROR = 4
+ESR_DEVICE_ERROR = 8
+ESR_EXECUTION_ERROR = 16
+ESR_COMMAND_ERROR = 32
+
+# First nodes of SOURce subsystem commands sent without the optional SOUR<n>
+SOURCE_NODES = {'APPL', 'FUNC', 'VOLT', 'FREQ', 'PHAS', 'AM', 'FM', 'PM', 'FSK', 'BPSK',
+                'PWM', 'SUM', 'BURS', 'SWE', 'DATA', 'MARK', 'RAT', 'TRAC', 'COMB'}
+# Subsystems numbered by channel, suffix 1 when left out
+CHANNEL_NODES = {'SOUR', 'OUTP', 'TRIG'}
+
+_MNEMONIC_RE = re.compile(r'([A-Za-z*]+)(\d*)$')
+
+
+class SCPIError(Exception):
+    """Error code and message for the error queue."""
+
+    def __init__(self, code, message):
+        super().__init__(f'{code:+d},"{message}"')
+        self.code = code
+
+
+def _short_form(word):
+    """SCPI short form of a mnemonic: 'ROSCillator' and 'ROSCILLATOR' -> 'ROSC'."""
+    if not word.isupper() and not word.islower():
+        return ''.join(c for c in word if c.isupper())
+    word = word.upper()
+    if len(word) <= 4:
+        return word
+    return word[:3] if word[3] in 'AEIOU' else word[:4]
+
+
+def canonical_header(header):
+    """
+    ('SOUR1:VOLT:OFFS', channel) for any spelling of a 33600A header:
+    long or short forms, with or without the optional SOURce node and the
+    channel suffix.
+    """
+    nodes = []
+    for mnemonic in header.strip(':').split(':'):
+        match = _MNEMONIC_RE.match(mnemonic)
+        if match is None:
+            raise SCPIError(-102, 'Syntax error')
+        word, suffix = match.groups()
+        nodes.append([_short_form(word), suffix])
+
+    if nodes[0][0] in SOURCE_NODES:
+        # FREQ1:STAR is SOUR1:FREQ:STAR
+        nodes.insert(0, ['SOUR', nodes[0][1]])
+        nodes[1][1] = ''
+    channel = None
+    if nodes[0][0] in CHANNEL_NODES:
+        nodes[0][1] = nodes[0][1] or '1'
+        channel = int(nodes[0][1])
+    elif nodes[0][0] == 'MMEM' and nodes[-1][1]:
+        # MMEM:LOAD:DATA2
+        channel = int(nodes[-1][1])
+    return ':'.join(word + suffix for word, suffix in nodes), channel
+
+
+def _unquote(text):
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '"\'':
+        return text[1:-1]
+    return text
+
+
+class SimulatedInstrument(abc.ABC):
+    """
+    State and common commands shared by the simulated models; execute()
+    runs one message and returns the replies to its queries.
+    """
+    idn = 'SIMULATED,AWG,0,0'
+
+    def __init__(self, channels=2, arb_memory=16_000_000, max_arb_points=4_000_000,
+                 byte_latency=0.0, command_latency=0.0, verbose=False):
+        self.channels = channels
+        self.arb_memory = arb_memory
+        self.max_arb_points = max_arb_points
+        self.byte_latency = byte_latency
+        self.command_latency = command_latency
+        self.verbose = verbose
+        # One client at a time talks to the instrument, like on the real one
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.block_bytes = 0
+        self.reset()
+        self.errors = []
+        self.esr = 0
+        self.ese = 0
+        self.sre = 0
+
+    def reset(self):
+        """*RST: default settings, empty volatile memory."""
+        self.settings = {}      # { header: value }
+        self.arbs = {ch: {} for ch in range(1, self.channels + 1)}   # { channel: { name: (points, digest) } }
+
+    # -----------------------------------------------------------------------
+
+    def push_error(self, error):
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(str(error))
+        else:
+            self.errors[-1] = '-350,"Queue overflow"'
+        code = getattr(error, 'code', -100)
+        if -199 <= code <= -100:
+            self.esr |= ESR_COMMAND_ERROR
+        elif -299 <= code <= -200:
+            self.esr |= ESR_EXECUTION_ERROR
+        elif -499 <= code <= -400:
+            self.esr |= ESR_QUERY_ERROR
+        else:
+            self.esr |= ESR_DEVICE_ERROR
+
+    def status_byte(self):
+        stb = 0
+        if self.errors:
+            stb |= 4
+        if self.esr & self.ese:
+            stb |= 32
+        if stb & self.sre:
+            stb |= 64
+        return stb
+
+    def common(self, header, args):
+        """A '*' command; returns its reply (None for commands)."""
+        if header == '*IDN?':
+            return self.idn
+        if header == '*OPC?':
+            return '1'
+        if header == '*OPC':
+            self.esr |= ESR_OPC
+            return None
+        if header == '*ESR?':
+            esr, self.esr = self.esr, 0
+            return str(esr)
+        if header == '*ESE':
+            self.ese = int(float(args))
+            return None
+        if header == '*ESE?':
+            return str(self.ese)
+        if header == '*SRE':
+            self.sre = int(float(args))
+            return None
+        if header == '*SRE?':
+            return str(self.sre)
+        if header == '*STB?':
+            return str(self.status_byte())
+        if header == '*CLS':
+            self.errors.clear()
+            self.esr = 0
+            return None
+        if header == '*RST':
+            self.reset()
+            return None
+        if header == '*TST?':
+            return '0'
+        if header in ('*WAI', '*TRG'):
+            return None
+        raise SCPIError(-113, 'Undefined header')
+
+    def next_error(self):
+        return self.errors.pop(0) if self.errors else '+0,"No error"'
+
+    def execute(self, units):
+        """Run one message (list of (text, block) units); returns the replies."""
+        self.messages += 1
+        if self.command_latency:
+            time.sleep(self.command_latency)
+        replies = []
+        for text, block in units:
+            header, _, args = text.strip().partition(' ')
+            try:
+                if header.startswith('*'):
+                    reply = self.common(header.upper(), args.strip())
+                elif header.upper().lstrip(':') in ('SYST:ERR?', 'SYSTEM:ERROR?', 'SYST:ERR:NEXT?'):
+                    reply = self.next_error()
+                else:
+                    reply = self.command(header, args.strip(), block)
+            except SCPIError as e:
+                self.push_error(e)
+                continue
+            except (ValueError, IndexError):
+                self.push_error(SCPIError(-224, 'Illegal parameter value'))
+                continue
+            if reply is not None:
+                replies.append(reply)
+        if self.verbose:
+            print(' ;'.join(t for t, _ in units)[:200], '->', replies)
+        return replies
+
+    @abc.abstractmethod
+    def command(self, header, args, block):
+        """Run one model-specific program unit; returns its reply, None if there is none."""
+
+    # -----------------------------------------------------------------------
+
+    def receive_block(self, block):
+        """Account for the transfer time of a binary block."""
+        self.block_bytes += len(block)
+        if self.byte_latency:
+            time.sleep(len(block) * self.byte_latency)
+
+    def store_arb(self, channel, name, points, data):
+        if channel not in self.arbs:
+            raise SCPIError(-114, 'Header suffix out of range')
+        if not 8 <= points <= self.max_arb_points:
+            raise SCPIError(-222, 'Data out of range')
+        memory = self.arbs[channel]
+        used = sum(p for n, (p, _) in memory.items() if n != name)
+        if used + points > self.arb_memory:
+            raise SCPIError(-225, 'Out of memory')
+        memory[name] = (points, hashlib.blake2b(data, digest_size=16).hexdigest())
+
+    def free_points(self, channel):
+        return self.arb_memory - sum(p for p, _ in self.arbs[channel].values())
+
+
+class Simulated33600A(SimulatedInstrument):
+    idn = 'Agilent Technologies,33622A,MY00000000,A.02.03-3.15-2.64-52-52'
+    # Size of the HCOP:SDUM:DATA? screen image (a PNG of the display)
+    screen_bytes = 60_000
+
+    SEQUENCE_PLAY = {'ONCE', 'ONCEWAITTRIG', 'REPEAT', 'REPEATINF', 'REPEATTILTRIG'}
+    SEQUENCE_MARKERS = {'MAINTAIN', 'LOWATSTART', 'HIGHATSTART', 'HIGHSTARTGOLOW'}
+    SEQUENCE_MAX_STEPS = 512
+
+    def reset(self):
+        super().reset()
+        self.settings['FORM:BORD'] = 'NORM'
+        self.sequences = {ch: {} for ch in range(1, self.channels + 1)}   # { channel: { name: [step] } }
+
+    def store_sequence(self, channel, block):
+        """DATA:SEQ: "name","arb",repeat,play,marker,point,... (arbs must be in volatile memory)."""
+        fields = [f.strip() for f in re.findall(r'"[^"]*"|[^,]+', block.decode('ascii'))]
+        name, steps = _unquote(fields[0]).upper(), fields[1:]
+        if not steps or len(steps) % 5 or len(steps) // 5 > self.SEQUENCE_MAX_STEPS:
+            raise SCPIError(-222, 'Data out of range')
+        sequence = []
+        for i in range(0, len(steps), 5):
+            arb, repeat, play, marker, point = steps[i:i + 5]
+            arb = _unquote(arb).upper()
+            if arb not in self.arbs[channel] or play.upper() not in self.SEQUENCE_PLAY \
+                    or marker.upper() not in self.SEQUENCE_MARKERS or not 1 <= int(repeat) <= 1_000_000:
+                raise SCPIError(-224, 'Illegal parameter value')
+            sequence.append((arb, int(repeat), play, marker, int(point)))
+        self.sequences[channel][name] = sequence
+        # Selected with FUNC:ARB like a waveform
+        self.arbs[channel].setdefault(name, (0, ''))
+
+    def command(self, header, args, block):
+        query = header.endswith('?')
+        key, channel = canonical_header(header.rstrip('?'))
+        general = re.sub(r'^(SOUR|OUTP|TRIG)\d', r'\1', key)
+
+        if general == 'SOUR:DATA:ARB:DAC' or general == 'SOUR:DATA:ARB':
+            if block is None:
+                raise SCPIError(-161, 'Invalid block data')
+            self.receive_block(block)
+            name = _unquote(args.rstrip(',')).upper()
+            order = '>' if self.settings['FORM:BORD'].startswith('NORM') else '<'
+            dtype = order + ('i2' if general.endswith('DAC') else 'f4')
+            if len(block) % np.dtype(dtype).itemsize:
+                raise SCPIError(-161, 'Invalid block data')
+            data = np.frombuffer(block, dtype=dtype)
+            if general.endswith('DAC') and np.abs(data.astype(np.int32)).max(initial=0) > 32767:
+                raise SCPIError(-222, 'Data out of range')
+            self.store_arb(channel, name, len(data), block)
+            return None
+        if general == 'SOUR:DATA:SEQ':
+            if block is None:
+                raise SCPIError(-161, 'Invalid block data')
+            self.store_sequence(channel, block)
+            return None
+        if general == 'SOUR:DATA:VOL:CLE':
+            self.arbs[channel].clear()
+            self.sequences[channel].clear()
+            return None
+        if general == 'SOUR:DATA:VOL:CAT' and query:
+            return ','.join(f'"{name}"' for name in self.arbs[channel]) or '""'
+        if general == 'SOUR:DATA:VOL:FREE' and query:
+            return str(self.free_points(channel))
+        if general == 'SOUR:DATA:VOL:COUN' and query:
+            return str(len(self.arbs[channel]))
+        if key.startswith('MMEM:LOAD:DATA') and not query:
+            # The file isn't read; it takes a slot in volatile memory under its name
+            self.arbs[channel or 1].setdefault(_unquote(args).upper(), (0, ''))
+            return None
+        if general == 'SOUR:FUNC:ARB' and not query:
+            name = _unquote(args).upper()
+            if name not in self.arbs[channel]:
+                raise SCPIError(-224, 'Illegal parameter value')
+        if general in ('SOUR:FUNC:ARB:SYNC', 'SOUR:PHAS:SYNC'):
+            return None
+        if key == 'HCOP:SDUM:DATA' and query:
+            # Screen image as a binary block (what the transport probe reads)
+            image = bytes(self.screen_bytes)
+            if self.byte_latency:
+                time.sleep(len(image) * self.byte_latency)
+            return block_reply(image)
+
+        if query:
+            if args:
+                # MIN/MAX and the like
+                return '0'
+            return self.settings.get(key, '0')
+        if not args:
+            raise SCPIError(-109, 'Missing parameter')
+        if general == 'SOUR:FUNC' and self.settings.get(key) != args:
+            # Changing the function re-derives the channel's other settings
+            prefix = f'SOUR{channel}:'
+            self.settings = {k: v for k, v in self.settings.items() if not k.startswith(prefix)}
+        self.settings[key] = args
+        return None
+
+
+class SimulatedSDG6022X(SimulatedInstrument):
+    idn = 'Siglent Technologies,SDG6022X,SDG6XBAX0R0000,6.01.01.35'
+
+    _HEADER_RE = re.compile(r'C(\d):(\w+)$', re.IGNORECASE)
+
+    def reset(self):
+        super().reset()
+        for ch in range(1, self.channels + 1):
+            self.settings[f'C{ch}:BSWV'] = {'WVTP': 'SINE', 'FRQ': '1000HZ', 'AMP': '4V', 'OFST': '0V', 'PHSE': '0'}
+            self.settings[f'C{ch}:OUTP'] = {'STATE': 'OFF', 'LOAD': 'HZ'}
+            self.settings[f'C{ch}:ARWV'] = {}
+
+    def command(self, header, args, block):
+        query = header.endswith('?')
+        match = self._HEADER_RE.match(header.rstrip('?').lstrip(':'))
+        if match is None:
+            raise SCPIError(-113, 'Undefined header')
+        channel, name = int(match.group(1)), match.group(2).upper()
+        if channel not in self.arbs:
+            raise SCPIError(-114, 'Header suffix out of range')
+        key = f'C{channel}:{name}'
+
+        if name == 'WVDT':
+            if block is None:
+                raise SCPIError(-161, 'Invalid block data')
+            self.receive_block(block)
+            fields = [f.strip() for f in args.split(',')]
+            wave_name = fields[fields.index('WVNM') + 1]
+            self.store_arb(channel, wave_name, len(block) // 2, block)
+            return None
+        if name == 'ARWV' and not query:
+            fields = [f.strip() for f in args.split(',')]
+            wave_name = fields[fields.index('NAME') + 1]
+            if wave_name not in self.arbs[channel]:
+                raise SCPIError(-224, 'Illegal parameter value')
+            self.settings[key] = {'NAME': wave_name}
+            return None
+
+        values = self.settings.setdefault(key, {})
+        if query:
+            if name == 'OUTP':
+                return f"{key} {values.get('STATE', 'OFF')},LOAD,{values.get('LOAD', 'HZ')}"
+            return f'{key} ' + ','.join(f'{k},{v}' for k, v in values.items())
+        fields = [f.strip() for f in args.split(',')]
+        if name == 'OUTP' and fields[0].upper() in ('ON', 'OFF'):
+            values['STATE'] = fields.pop(0).upper()
+        if len(fields) % 2:
+            raise SCPIError(-109, 'Missing parameter')
+        for param, value in zip(fields[::2], fields[1::2]):
+            values[param.upper()] = value
+        return None
+
+
+def block_reply(data):
+    """data as an IEEE 488.2 definite-length block reply."""
+    length = str(len(data))
+    return f'#{len(length)}{length}'.encode('ascii') + data
+
+
+MODELS = {'33600a': Simulated33600A, 'sdg6022x': SimulatedSDG6022X}
+
+
+class _Reader:
+    """Splits the byte stream from one client into messages of (text, block) units."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b''
+        self.pos = 0
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def _byte(self):
+        if self.pos >= len(self.buf):
+            self._fill()
+        b = self.buf[self.pos]
+        self.pos += 1
+        return b
+
+    def _exact(self, n):
+        out = bytearray(n)
+        view = memoryview(out)
+        got = min(n, len(self.buf) - self.pos)
+        view[:got] = self.buf[self.pos:self.pos + got]
+        self.pos += got
+        while got < n:
+            k = self.sock.recv_into(view[got:], n - got)
+            if k == 0:
+                raise EOFError
+            got += k
+        return out
+
+    def read_message(self):
+        """The next message's units, or None once the client has gone."""
+        units = []
+        text = bytearray()
+        block = None
+        quote = None
+        try:
+            while True:
+                b = self._byte()
+                if quote is not None:
+                    text.append(b)
+                    if b == quote:
+                        quote = None
+                elif b in b'"\'':
+                    quote = b
+                    text.append(b)
+                elif b == ord('#'):
+                    digits = self._byte()
+                    if not ord('1') <= digits <= ord('9'):
+                        # Not a definite-length block (#H1F and the like)
+                        text += bytes([b, digits])
+                        continue
+                    length = int(self._exact(digits - ord('0')))
+                    block = bytes(self._exact(length))
+                elif b == ord(';') or b == ord('\n'):
+                    unit = text.decode('ascii', 'replace').strip()
+                    if unit or block is not None:
+                        units.append((unit, block))
+                    text, block = bytearray(), None
+                    if b == ord('\n'):
+                        return units
+                else:
+                    text.append(b)
+        except EOFError:
+            return None
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        instrument = self.server.instrument
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = _Reader(self.request)
+        while True:
+            units = reader.read_message()
+            if units is None:
+                return
+            if not units:
+                continue
+            with instrument.lock:
+                replies = instrument.execute(units)
+            if replies:
+                replies = [r if isinstance(r, bytes) else r.encode('ascii') for r in replies]
+                self.request.sendall(b';'.join(replies) + b'\n')
+
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, instrument, port=5025, host='127.0.0.1'):
+        super().__init__((host, port), _Handler)
+        self.instrument = instrument
+
+    @property
+    def address(self):
+        """VISA resource string of the simulator."""
+        host, port = self.server_address
+        return f'TCPIP::{host}::{port}::SOCKET'
+
+
+def start(model='33600a', port=5025, host='127.0.0.1', **kwargs):
+    """Start a simulator in a background thread and return its server (port=0 picks a free port)."""
+    server = SimulatorServer(MODELS[model](**kwargs), port, host)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated AWG on a SCPI socket')
+    parser.add_argument('--model', choices=sorted(MODELS), default='33600a')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5025)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--arb-memory', type=int, default=16_000_000, help='points of volatile memory per channel')
+    parser.add_argument('--max-arb-points', type=int, default=4_000_000, help='longest single waveform')
+    parser.add_argument('--byte-latency', type=float, default=0.0, help='seconds per byte of block data')
+    parser.add_argument('--command-latency', type=float, default=0.0, help='seconds per message')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = SimulatorServer(
+        MODELS[args.model](
+            channels=args.channels, arb_memory=args.arb_memory, max_arb_points=args.max_arb_points,
+            byte_latency=args.byte_latency, command_latency=args.command_latency, verbose=args.verbose,
+        ),
+        args.port, args.host,
+    )
+    print(f'Simulated {args.model} at {server.address}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nShutting down...')
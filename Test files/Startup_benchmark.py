@@ -0,0 +1,198 @@
+#
+#   Startup time of the ZMQ server, with budgets so import-time regressions
+#   show up (exit status 1 when a budget is exceeded):
+#
+#     - time to import what main.py imports before serving, in a fresh
+#       interpreter, and the heaviest modules among them (-X importtime)
+#     - none of the heavy dependencies (pylablib, pydantic, pyvisa, scipy,
+#       streamlit, Qt...) may be loaded by then: drivers load in the
+#       devices' connection threads
+#     - time from starting the server process to its first 'ping' reply,
+#       and to the first command answered by a (simulated) generator
+#
+#   python "Test files/Startup_benchmark.py"
+#   python "Test files/Startup_benchmark.py" --import-budget 0.3 --output startup.json
+#
+
+import sys
+import json
+import time
+import argparse
+import subprocess
+from datetime import datetime
+
+import zmq
+
+from Benchmark_suite import ROOT, SIMULATOR, Client, free_port, wait_for_port, git_commit
+
+# What main.py imports before it starts serving
+SERVER_IMPORTS = '''
+import zmq, asyncio
+from contextlib import ExitStack
+from core.Server import serve, serve_async
+from core import Program, Metrics, Tracing, Startup
+'''
+
+# Must not be imported before the server is up
+HEAVY_MODULES = ('pylablib', 'pydantic', 'pyvisa', 'pyvisa_py', 'scipy', 'pandas', 'numba', 'streamlit',
+                 'PyQt5', 'PyQt6', 'PySide2', 'PySide6', 'Equipment.agilent33600A', 'Equipment.sdg6022x')
+
+
+def measure_imports():
+    """(seconds, heavy modules loaded) for SERVER_IMPORTS in a fresh interpreter."""
+    code = (
+        'import sys, time, json\n'
+        't = time.perf_counter()\n'
+        f'{SERVER_IMPORTS}\n'
+        't = time.perf_counter() - t\n'
+        f'print(json.dumps([t, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))\n'
+    )
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, text=True)
+    return json.loads(out.splitlines()[-1])
+
+
+def _top_level_imports(code):
+    """[(module, cumulative us)] of the top-level imports done by running code."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            # Top level (nested imports are indented further)
+            modules.append((name.strip(), int(cumulative)))
+    return modules
+
+
+def heaviest_imports(n=10):
+    """The n top-level imports of SERVER_IMPORTS with the largest cumulative time (us)."""
+    interpreter = {name for name, _ in _top_level_imports('pass')}
+    modules = [m for m in _top_level_imports(SERVER_IMPORTS) if m[0] not in interpreter]
+    return sorted(modules, key=lambda m: -m[1])[:n]
+
+
+def run_server(address, devices_arg, deadline):
+    """Child process: start like main.py, devices connecting in the background."""
+    sys.path.insert(0, str(ROOT))
+    from contextlib import ExitStack
+    from core.Server import serve
+    from core import Startup
+
+    configs = {}
+    for spec in devices_arg:
+        name, addr = spec.split('=', 1)
+        configs[name] = ('Agilent33600A', addr)
+    with ExitStack() as stack:
+        stack.callback(Startup.close_devices)
+        Startup.connect_devices(configs, deadline=deadline, wait=False)
+        context = stack.enter_context(zmq.Context())
+        try:
+            serve(context, address)
+        except KeyboardInterrupt:
+            pass
+
+
+def measure_server(deadline):
+    """Seconds from starting the server process to the first ping reply and first device reply."""
+    port = free_port()
+    simulator = subprocess.Popen([sys.executable, str(SIMULATOR), '--port', str(port)])
+    wait_for_port(port)
+    address = f'tcp://127.0.0.1:{free_port()}'
+    context = zmq.Context()
+    client = Client(context, address, timeout_ms=int(1000 * (deadline + 30)))
+    try:
+        start = time.perf_counter()
+        server = subprocess.Popen([
+            sys.executable, __file__, '--serve', address, '--device', f'AG33600A_Sim=TCPIP::127.0.0.1::{port}::SOCKET',
+            '--deadline', str(deadline),
+        ], cwd=ROOT)
+        try:
+            # REQ queues the request until the server has bound its socket
+            client.call('ping')
+            ping = time.perf_counter() - start
+            # Waits in the server until the generator is connected
+            client.call('A33ReadError', 'AG33600A_Sim')
+            device = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        client.close()
+        context.term()
+        simulator.terminate()
+        simulator.wait()
+    return ping, device
+
+
+def main(args):
+    failures = []
+    import_times = []
+    loaded = []
+    for _ in range(args.repeat):
+        seconds, loaded = measure_imports()
+        import_times.append(seconds)
+    import_s = min(import_times)
+    print(f'Server imports: {import_s * 1e3:.1f} ms (best of {args.repeat}, budget {args.import_budget * 1e3:.0f} ms)')
+    heaviest = heaviest_imports()
+    for name, us in heaviest:
+        print(f'  {us / 1e3:8.1f} ms  {name}')
+    if import_s > args.import_budget:
+        failures.append(f'imports took {import_s * 1e3:.1f} ms')
+    if loaded:
+        print(f'Heavy modules loaded before serving: {", ".join(loaded)}')
+        failures.append(f'heavy modules loaded: {", ".join(loaded)}')
+
+    ping_times, device_times = [], []
+    for _ in range(args.repeat):
+        ping, device = measure_server(args.deadline)
+        ping_times.append(ping)
+        device_times.append(device)
+    ping_s = min(ping_times)
+    device_s = min(device_times)
+    print(f'Process start to first ping reply: {ping_s * 1e3:.1f} ms (budget {args.ping_budget * 1e3:.0f} ms)')
+    print(f'Process start to first generator reply: {device_s * 1e3:.1f} ms')
+    if ping_s > args.ping_budget:
+        failures.append(f'first ping reply after {ping_s * 1e3:.1f} ms')
+
+    results = {
+        'meta': {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'options': {k: v for k, v in vars(args).items() if k not in ('serve', 'device')},
+        },
+        'import_s': import_times,
+        'heaviest_imports_us': dict(heaviest),
+        'heavy_modules_loaded': loaded,
+        'ping_s': ping_times,
+        'first_device_reply_s': device_times,
+        'failures': failures,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {args.output}')
+
+    for failure in failures:
+        print(f'OVER BUDGET: {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Server startup time against import-time budgets')
+    parser.add_argument('--import-budget', type=float, default=0.5, help='seconds for the server imports')
+    parser.add_argument('--ping-budget', type=float, default=1.0, help='seconds from process start to first ping reply')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--deadline', type=float, default=10.0, help='startup deadline given to the server')
+    parser.add_argument('--output', help='JSON file for the results')
+    # Internal: run as the server process
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--device', action='append', default=[], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args.serve, args.device, args.deadline)
+    else:
+        sys.exit(main(args))
@@ -0,0 +1,288 @@
+"""
+Ahead-of-time compilation of command sequences to the SCPI messages they send.
+
+A program (a JSON batch or CommandSetC11v027 text, see core.Program) is
+validated and run once against a recorder standing in for each device.
+Replaying it then just writes the recorded messages (inside the device's
+batch(), through its shadow state), so formatting and validation are paid
+once per program instead of once per shot.
+
+Programs can have parameters: {"$param": "name"} as a JSON argument value or
+$name in program text, with a default given at compile time. A replay with
+other values only re-derives the steps that use a changed parameter (their
+line or message is validated and recorded again, so a command whose output
+depends on the value, e.g. A33ConfigureARB skipping the phase at 360, is
+still right). A parameter that changes which commands run (compiling it at
+another value gives other steps) is 'structural' and a new value recompiles
+the program instead.
+
+Commands that do more than write (queries, uploads, @long_running or
+@runs_live commands) are kept as live calls with their arguments validated.
+"""
+import re
+import json
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import lru_cache, partial
+
+from core import devices, Dispatch
+from core.Program import Program
+
+compiled = {}   # { program_id: CompiledProgram }
+
+# Recompiled variants kept per program for structural parameter values
+MAX_VARIANTS = 32
+
+_PARAM_RE = re.compile(r'\$(\w+)')
+
+
+class NotCompilable(Exception):
+    """Raised while recording when a command does more than write."""
+
+
+def _refuse(self, *args, **kwargs):
+    raise NotCompilable()
+
+
+@lru_cache(None)
+def _recorder_class(cls):
+    """A subclass of device class cls whose instances record their writes."""
+    class Recorder(cls):
+        def write(self, msg, arg=None, arg_type=None, unit=None, bool_selector=None, wait_sync=None,
+                  read_echo=False, **kwargs):
+            if wait_sync or read_echo:
+                raise NotCompilable()
+            self._recorded.append(self._compose_msg(msg, arg, arg_type, unit, bool_selector))
+
+        ask = read = _refuse
+
+        @property
+        def instr(self):
+            # Anything else that would talk to the instrument
+            raise NotCompilable()
+
+    Recorder.__name__ = Recorder.__qualname__ = f'{cls.__name__}Recorder'
+    return Recorder
+
+
+def _record(instr, call):
+    """
+    The messages call() writes to devices[instr], or None if it must run live.
+    call runs against a copy of the device that records instead of sending,
+    so the device itself is untouched and can keep working meanwhile.
+    """
+    device = devices[instr]
+    recorder = object.__new__(_recorder_class(type(device)))
+    recorder.__dict__.update(device.__dict__)
+    recorder._recorded = messages = []
+    method = call.func
+    try:
+        result = partial(method.__func__.__get__(recorder), *call.args, **call.keywords)()
+    except NotCompilable:
+        return None
+    return messages if result is None else None
+
+
+def _fill(value, values):
+    if isinstance(value, dict) and '$param' in value:
+        return values[value['$param']]
+    return value
+
+
+def _alternatives(value):
+    """Other values to compile a parameter at, to see whether it changes the steps."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return []
+    if isinstance(value, int):
+        return [value + 1, value - 1, value + 2]
+    return [value * 1.1 + 0.1, value * 0.9, value + 1.0, value - 1.0, value / 2]
+
+
+class CompiledStep:
+    def __init__(self, instr, cmd, call, messages, params, derive):
+        self.instr = instr
+        self.cmd = cmd
+        self.call = call            # validated call, run if messages is None
+        self.messages = messages    # recorded SCPI messages
+        self.params = params        # names of the parameters in the step's arguments
+        self.derive = derive        # values -> validated call with those parameter values
+
+
+class CompiledProgram:
+    """
+    source is CommandSetC11v027 program text or a list of JSON commands
+    ({"instr": ..., "cmd": ..., args}); params gives every parameter's
+    default. submit(instr, fn) runs fn on the device's worker (the server
+    passes the per-device executors), by default it runs here.
+    run() may be called from several threads at once.
+    """
+
+    def __init__(self, source, params=None, wfm_file=None, skip_unknown=False, submit=None):
+        self.source = source
+        self.params = dict(params or {})
+        self.wfm_file = wfm_file
+        self.skip_unknown = skip_unknown
+        self.submit = submit or (lambda instr, fn: fn())
+        self.digest = program_id(source, self.params, wfm_file, skip_unknown)
+        self._lock = threading.Lock()   # guards the compiled steps and variants
+        self._build()
+
+    def _build(self):
+        self.steps = self._compile(self.params)
+        self.devices = {step.instr: devices[step.instr] for step in self.steps}
+        self.slots = set()          # parameters replays re-derive the steps of
+        self.structural = set()     # parameters replays recompile for
+        self.variants = OrderedDict()
+        for name in self.params:
+            if self._changes_steps(name):
+                self.structural.add(name)
+            else:
+                self.slots.add(name)
+
+    def _substitute(self, text, values):
+        missing = set(_PARAM_RE.findall(text)) - set(values)
+        if missing:
+            raise ValueError(f'No value for parameters {sorted(missing)}')
+        return _PARAM_RE.sub(lambda m: repr(values[m.group(1)]), text)
+
+    def _steps(self, values):
+        """(instr, cmd, validated call, parameter names, derive) of each step, with values filled in."""
+        if isinstance(self.source, str):
+            program = Program(self._substitute(self.source, values), wfm_file=self.wfm_file,
+                              skip_unknown=self.skip_unknown)
+            lines = self.source.splitlines()
+            steps = []
+            for step in program.steps:
+                line = lines[step.line_no - 1]
+                derive = lambda values, line_no=step.line_no, line=line: Program._parse_line(
+                    line_no, self._substitute(line, values), self.wfm_file).call
+                steps.append((step.instr, step.method_name, step.call, set(_PARAM_RE.findall(line)), derive))
+            return steps
+
+        steps = []
+        for message in self.source:
+            instr, cmd = message['instr'], message['cmd']
+            try:
+                command = Dispatch.table[instr, cmd]
+            except KeyError:
+                raise KeyError(f'Unknown command {cmd} for {instr}') from None
+            args = {k: v for k, v in message.items() if k not in ('instr', 'cmd')}
+            derive = lambda values, command=command, args=args: command.prepare(
+                **{k: _fill(v, values) for k, v in args.items()})
+            params = {v['$param'] for v in args.values() if isinstance(v, dict) and '$param' in v}
+            steps.append((instr, cmd, derive(values), params, derive))
+        return steps
+
+    def _compile(self, values):
+        steps = []
+        for instr, cmd, call, params, derive in self._steps(values):
+            command = Dispatch.table[instr, cmd]
+            messages = None
+            if not (command.long_running or command.runs_live):
+                messages = _record(instr, call)
+            steps.append(CompiledStep(instr, cmd, call, messages, params, derive))
+        return steps
+
+    def _changes_steps(self, name):
+        """Whether another value of parameter name runs other commands (or fails to compile)."""
+        for value in _alternatives(self.params[name]):
+            try:
+                other = self._compile(dict(self.params, **{name: value}))
+            except Exception:
+                continue
+            break
+        else:
+            return True
+        return [(step.instr, step.cmd) for step in other] != [(step.instr, step.cmd) for step in self.steps]
+
+    def describe(self):
+        return {
+            "id": self.digest,
+            "steps": len(self.steps),
+            "live": sum(step.messages is None for step in self.steps),
+            "slots": sorted(self.slots),
+            "structural": sorted(self.structural),
+        }
+
+    def _rederived(self, steps, values):
+        """{step index: (call, messages)} of the steps that use a changed parameter."""
+        changed = {name for name in self.slots if values[name] != self.params[name]}
+        rederived = {}
+        for i, step in enumerate(steps):
+            if step.params & changed:
+                call = step.derive(values)
+                messages = _record(step.instr, call) if step.messages is not None else None
+                rederived[i] = (call, messages)
+        return rederived
+
+    def run(self, values=None, stop_on_error=True):
+        """Replay the program with some parameters changed; returns the steps' replies."""
+        values = dict(self.params, **(values or {}))
+        unknown = set(values) - set(self.params)
+        if unknown:
+            raise ValueError(f'Unknown parameters {sorted(unknown)}')
+        with self._lock:
+            if not all(devices.get(instr) is dev for instr, dev in self.devices.items()):
+                # A device was re-registered: record again against the new one
+                self._build()
+            steps = self.steps
+
+        if all(values[name] == self.params[name] for name in self.structural):
+            rederived = self._rederived(steps, values)
+        else:
+            key = tuple(sorted(values.items()))
+            with self._lock:
+                variant = self.variants.get(key)
+                if variant is not None:
+                    self.variants.move_to_end(key)
+            if variant is None:
+                variant = self._compile(values)
+                with self._lock:
+                    self.variants[key] = variant
+                    if len(self.variants) > MAX_VARIANTS:
+                        self.variants.popitem(last=False)
+            steps, rederived = variant, {}
+
+        results = []
+        indexed = list(enumerate(steps))
+        for instr, group in itertools.groupby(indexed, key=lambda item: item[1].instr):
+            group = list(group)
+            replies, failed = self.submit(instr, lambda: _replay(instr, group, rederived, stop_on_error))
+            results += replies
+            if failed and stop_on_error:
+                break
+        return results
+
+
+def _replay(instr, group, rederived, stop_on_error):
+    device = devices[instr]
+    replies = []
+    failed = False
+    coalesce = getattr(device, 'batch', None) if len(group) > 1 else None
+    with (coalesce() if coalesce else nullcontext()):
+        for i, step in group:
+            call, messages = rederived.get(i, (step.call, step.messages))
+            try:
+                if messages is None:
+                    result = call()
+                else:
+                    for msg in messages:
+                        device.write(msg)
+                    result = None
+            except Exception as e:
+                replies.append(f'ERROR step {i} ({step.cmd}): {e}')
+                failed = True
+                if stop_on_error:
+                    break
+            else:
+                replies.append('Operation complete' if result is None else str(result))
+    return replies, failed
+
+
+def program_id(source, params, wfm_file=None, skip_unknown=False):
+    """Hash of everything a compiled program depends on."""
+    key = json.dumps([source, sorted(params.items()), wfm_file, skip_unknown], default=str)
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
@@ -0,0 +1,147 @@
+import inspect
+import threading
+from functools import lru_cache, partial
+
+from core import Metrics
+
+table = {}      # { ("AG33600A_Gen1", "A33Trg"): Command }
+calls = {}      # { "AG33600A_Gen1": { "A33Trg": Command.call } }, looked up by dispatch
+
+# Devices register from parallel connection threads (core.Startup): the
+# tables are replaced, never changed in place, so readers need no lock
+_lock = threading.Lock()
+
+
+class Command:
+    """
+    A device command prepared once, when its device is registered.
+
+    Normally the command is called exactly like the method (so validate_call
+    checks every call). In fast (trusted) mode the arguments of a
+    validate_call command are validated once per distinct set of values and
+    the coerced values are reused, calling the undecorated method directly.
+    A validate_call command without parameters has nothing to validate and
+    is always called undecorated (unexpected arguments still raise).
+    With core.Metrics enabled, validation is done separately from the call so
+    its time shows up as the 'validate' phase.
+    """
+
+    def __init__(self, name, method, fast=False, cache_size=256):
+        self.name = name
+        self.method = method
+        self.signature = inspect.signature(method)
+        self.long_running = getattr(method, '_long_running', False)
+        self.runs_live = getattr(method, '_runs_live', False)
+        # pydantic's validate_call exposes the undecorated function as raw_function
+        self.validated = callable(getattr(method, 'raw_function', None))
+        self.fast = fast and self.validated and len(self.signature.parameters) > 0
+        # What dispatch calls with the request's keyword arguments
+        if self.validated and not self.signature.parameters:
+            self.call = _raw(method)
+        elif self.fast:
+            self.call = _fast_caller(method, cache_size)
+        elif self.validated and Metrics.enabled and self.signature.parameters:
+            self.call = _timed_caller(method)
+        else:
+            self.call = method
+        self._validate = None
+
+    def prepare(self, **kwargs):
+        """
+        Validate kwargs now and return a callable that runs the command with
+        them later without validating again (used by core.Program).
+        """
+        if not self.validated:
+            self.signature.bind(**kwargs)
+            return partial(self.method, **kwargs)
+        if self._validate is None:
+            self._validate = _argument_validator(self.method)
+        args, kwargs = self._validate(**kwargs)
+        return partial(_raw(self.method), *args, **kwargs)
+
+
+def _raw(method):
+    """The undecorated method of a validate_call method (its raw_function), bound like it."""
+    return method.raw_function.__get__(method.__self__)
+
+
+def _argument_validator(method):
+    """
+    validate_call on a function with the undecorated method's signature
+    that returns its arguments.
+
+    Built with the default config; if the signature has types pydantic has
+    no schema for (which the method's own validate_call must then allow),
+    with arbitrary_types_allowed, so those are isinstance-checked as there.
+    pydantic is imported here, on the first device registration, so the
+    server can start without it.
+    """
+    from pydantic import validate_call
+    from pydantic.errors import PydanticSchemaGenerationError
+
+    func = _raw(method)
+    def capture(*args, **kwargs):
+        return args, kwargs
+    capture.__signature__ = inspect.signature(func)
+    capture.__annotations__ = dict(getattr(func, '__annotations__', {}))
+    capture.__name__ = capture.__qualname__ = func.__name__
+    try:
+        return validate_call(capture)
+    except PydanticSchemaGenerationError:
+        return validate_call(capture, config=dict(arbitrary_types_allowed=True))
+
+
+def _fast_caller(method, cache_size):
+    raw = _raw(method)
+    validate = _argument_validator(method)
+
+    # The types are part of the key, since 1 == 1.0 == True
+    @lru_cache(cache_size)
+    def validate_cached(items, types):
+        return validate(**dict(items))
+
+    def validate_fast(kwargs):
+        try:
+            return validate_cached(tuple(kwargs.items()), tuple(map(type, kwargs.values())))
+        except TypeError:
+            # Unhashable value (list, dict...): validate without caching
+            return validate(**kwargs)
+
+    if Metrics.enabled:
+        def call(**kwargs):
+            with Metrics.phase('validate'):
+                args, kwargs = validate_fast(kwargs)
+            return raw(*args, **kwargs)
+    else:
+        def call(**kwargs):
+            args, kwargs = validate_fast(kwargs)
+            return raw(*args, **kwargs)
+    return call
+
+
+def _timed_caller(method):
+    raw = _raw(method)
+    validate = _argument_validator(method)
+
+    def call(**kwargs):
+        with Metrics.phase('validate'):
+            args, kwargs = validate(**kwargs)
+        return raw(*args, **kwargs)
+    return call
+
+
+def compile_device(instr, commands, fast=False):
+    """(Re)build the table entries of one device from its commands dict."""
+    global table, calls
+    entries = {name: Command(name, method, fast) for name, method in commands.items()}
+    with _lock:
+        new_table = {key: command for key, command in table.items() if key[0] != instr}
+        new_table.update(((instr, name), command) for name, command in entries.items())
+        new_calls = dict(calls)
+        new_calls[instr] = {name: command.call for name, command in entries.items()}
+        table, calls = new_table, new_calls
+
+
+def describe(instr):
+    """{command: signature string} for one device."""
+    return {name: str(command.signature) for (i, name), command in table.items() if i == instr}
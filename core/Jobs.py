@@ -0,0 +1,36 @@
+import itertools
+import threading
+
+jobs = {}   # { job_id: concurrent.futures.Future }
+
+_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+def submit(executor, fn, *args, **kwargs):
+    """Run fn on executor in the background and return its job ID."""
+    future = executor.submit(fn, *args, **kwargs)
+    with _lock:
+        job_id = next(_ids)
+        jobs[job_id] = future
+    return job_id
+
+
+def get(job_id):
+    try:
+        return jobs[int(job_id)]
+    except KeyError:
+        raise KeyError(f'Unknown job {job_id}') from None
+
+
+def status(job_id):
+    """'pending', 'running', 'done' or 'failed'."""
+    future = get(job_id)
+    if not future.done():
+        return 'running' if future.running() else 'pending'
+    return 'failed' if future.exception() is not None else 'done'
+
+
+def forget(job_id):
+    with _lock:
+        jobs.pop(int(job_id), None)
@@ -0,0 +1,290 @@
+"""
+Timing histograms and I/O counters for every command the server runs.
+
+Each dispatched command gets a context (thread-local, so per device worker)
+and its time is split into phases:
+    decode    JSON parsing and binary frame attachment (server loop)
+    validate  pydantic argument validation (core.Dispatch)
+    io        VISA writes and reads (the drivers' _instr_write/_instr_read
+              and visa_utils.write_binary_block)
+    wait      waiting for the instrument: *OPC? and completion waits
+              (visa_utils.wait_complete)
+    total     the whole dispatch
+Phases don't nest: time spent in an inner phase (a *OPC? read inside a
+wait) counts for the outer one only.
+
+Counters (bytes written/read over VISA, upload retries...) are kept per
+device. The stats server command returns a snapshot as JSON, and
+write_prometheus() / start_prometheus_dump() produce the Prometheus text
+format for node_exporter's textfile collector.
+
+Profiling is off by default, so the dispatch path only counts commands
+('commands' counter of each device). Set enabled = True (main.py's profile
+option) before registering devices to time every command and phase; the
+I/O counters are kept either way. With core.Tracing enabled, commands and
+phases are also recorded as spans on a timeline.
+"""
+import os
+import time
+import bisect
+import threading
+
+from core import Tracing
+
+enabled = False
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (
+    1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2,
+    5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'),
+)
+
+PHASES = ('decode', 'validate', 'io', 'wait', 'total')
+
+# Name used for commands without an instrument (server commands)
+SERVER = 'server'
+
+# Every thread records into its own tables (no locking on the hot path);
+# snapshot() adds them up
+_tables = []        # [ ({ (instr, cmd, phase): Histogram }, { (instr, name): number }) ]
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q (None if empty)."""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if n and seen >= rank:
+                return bound
+        return None
+
+
+def _thread_tables():
+    tables = getattr(_local, 'tables', None)
+    if tables is None:
+        tables = _local.tables = ({}, {})
+        with _lock:
+            _tables.append(tables)
+    return tables
+
+
+def observe(instr, cmd, phase, seconds):
+    histograms = _thread_tables()[0]
+    key = (instr or SERVER, cmd, phase)
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = Histogram()
+    histogram.observe(seconds)
+
+
+def set_device(instr):
+    """
+    The device this thread's counters go to when there is no command
+    context (profiling off). dispatch sets it for every command, so it
+    costs one thread-local assignment.
+    """
+    _local.instr = instr
+
+
+def count(name, n=1, instr=None):
+    """Add n to a counter of instr (by default, the device of the current command)."""
+    if instr is None:
+        context = getattr(_local, 'context', None)
+        instr = context.instr if context is not None else getattr(_local, 'instr', None)
+    try:
+        counters = _local.tables[1]
+    except AttributeError:
+        counters = _thread_tables()[1]
+    key = (instr or SERVER, name)
+    counters[key] = counters.get(key, 0) + n
+
+
+class command:
+    """
+    with command(instr, cmd): the context of one dispatched command; its
+    phase times and total are recorded on exit. channel only tags the
+    command's trace spans.
+    """
+    __slots__ = ('instr', 'cmd', 'channel', 'phase', 'times', 'start', 'outer')
+
+    def __init__(self, instr, cmd, channel=None):
+        self.instr = instr
+        self.cmd = cmd
+        self.channel = channel
+        self.phase = None
+        self.times = {}
+
+    def __enter__(self):
+        self.outer = getattr(_local, 'context', None)
+        _local.context = self
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _local.context = self.outer
+        if Tracing.enabled:
+            Tracing.span(self.cmd, self.start, end, 'command', self.instr, self.channel)
+        if not enabled:
+            return
+        for phase_name, seconds in self.times.items():
+            observe(self.instr, self.cmd, phase_name, seconds)
+        observe(self.instr, self.cmd, 'total', end - self.start)
+
+
+class phase:
+    """
+    with phase('io'): add the block's time to that phase of the current
+    command. label and detail (e.g. 'VISA write' and the message) name its
+    trace span.
+    """
+    __slots__ = ('name', 'label', 'detail', 'context', 'start')
+
+    def __init__(self, name, label=None, detail=None):
+        self.name = name
+        self.label = label
+        self.detail = detail
+        self.context = None
+
+    def __enter__(self):
+        context = getattr(_local, 'context', None)
+        if context is not None and context.phase is None:
+            context.phase = self.name
+            self.context = context
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        context = self.context
+        if context is not None:
+            context.phase = None
+            context.times[self.name] = context.times.get(self.name, 0.0) + end - self.start
+            self.context = None
+        if Tracing.enabled:
+            # Nested phases are traced too, inside their outer one
+            context = getattr(_local, 'context', None)
+            instr, channel = (context.instr, context.channel) if context is not None else (None, None)
+            Tracing.span(self.label or self.name, self.start, end, self.name, instr, channel, self.detail)
+
+
+def reset():
+    with _lock:
+        for histograms, counters in _tables:
+            histograms.clear()
+            counters.clear()
+
+
+def _merged():
+    """All threads' tables added up: ({key: Histogram}, {key: number})."""
+    histograms, counters = {}, {}
+    with _lock:
+        tables = list(_tables)
+    for thread_histograms, thread_counters in tables:
+        # Copies, as the owning thread may be adding entries
+        for key, h in list(thread_histograms.items()):
+            histograms.setdefault(key, Histogram()).merge(h)
+        for key, value in list(thread_counters.items()):
+            counters[key] = counters.get(key, 0) + value
+    return histograms, counters
+
+
+def _us(seconds):
+    return None if seconds is None else seconds * 1e6
+
+
+def snapshot():
+    """
+    {"commands": {instr: {cmd: {phase: {count, mean_us, p50_us, p99_us}}}},
+     "counters": {instr: {name: value}}}
+    Percentiles are bucket upper bounds.
+    """
+    histograms, counters = _merged()
+    items = [(key, h.count, h.sum, h.quantile(0.5), h.quantile(0.99)) for key, h in histograms.items()]
+    counter_items = list(counters.items())
+    commands = {}
+    for (instr, cmd, phase_name), n, total, p50, p99 in sorted(items, key=lambda item: item[0]):
+        commands.setdefault(instr, {}).setdefault(cmd, {})[phase_name] = {
+            "count": n,
+            "mean_us": _us(total / n),
+            "p50_us": _us(p50),
+            "p99_us": _us(p99),
+        }
+    values = {}
+    for (instr, name), value in sorted(counter_items):
+        values.setdefault(instr, {})[name] = value
+    return {"commands": commands, "counters": values}
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus_text():
+    histograms, counters = _merged()
+    items = [(key, h.counts, h.sum, h.count) for key, h in histograms.items()]
+    counter_items = list(counters.items())
+    lines = [
+        '# HELP qd_command_seconds Time spent per command and phase.',
+        '# TYPE qd_command_seconds histogram',
+    ]
+    for (instr, cmd, phase_name), counts, total, n in sorted(items, key=lambda item: item[0]):
+        labels = f'instr="{_label(instr)}",cmd="{_label(cmd)}",phase="{phase_name}"'
+        cumulative = 0
+        for bound, c in zip(BUCKETS, counts):
+            cumulative += c
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'qd_command_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'qd_command_seconds_sum{{{labels}}} {total!r}')
+        lines.append(f'qd_command_seconds_count{{{labels}}} {n}')
+    names = sorted({name for _, name in counter_items})
+    for name in names:
+        lines.append(f'# TYPE qd_{name}_total counter')
+        for (instr, counter_name), value in sorted(counter_items):
+            if counter_name == name:
+                lines.append(f'qd_{name}_total{{instr="{_label(instr)}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    """Write the metrics in Prometheus text format (replacing path atomically)."""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+
+def start_prometheus_dump(path, interval=10.0):
+    """Rewrite the Prometheus text file every interval seconds, in a daemon thread."""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                write_prometheus(path)
+            except OSError as e:
+                print(f'Could not write metrics to {path}: {e}')
+
+    thread = threading.Thread(target=run, name='metrics-dump', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,256 @@
+"""
+Run experiment programs written by CommandSetC11v027.wl on the Python side.
+
+A program is text with one command per line, tab separated:
+    CommandN <tab> code <tab> NAME <tab> params...
+(numbers are printed by Mathematica's NumberForm, so integers look like
+'3.'). The A33* commands are mapped to Agilent33600A methods and every line
+is validated before anything is sent, so a bad program fails before it
+touches an instrument.
+"""
+import hashlib
+import itertools
+from contextlib import nullcontext
+
+from core import devices, Dispatch
+
+# DeviceID used in programs (33600, 33601, 33602) -> registered device name.
+# If an ID is missing and exactly one A33 device is registered, that is used.
+device_ids = {}     # { 33600: "AG33600A_Gen1" }
+
+# Lines that only annotate the program
+NO_OPS = {'NULL', 'LABEL'}
+
+
+class UnknownCommand(KeyError):
+    """A program line for a command this executor doesn't implement."""
+
+
+def _ch(channel):
+    """Programs number channels 0 and 1."""
+    return int(channel) + 1
+
+
+def _on(value):
+    """Programs use 0 for off and anything > 0 for on."""
+    return value > 0
+
+
+def _freq(freq):
+    """Freq <= 0 means 'take it from that register', which isn't implemented here."""
+    if freq <= 0:
+        raise ValueError(f'Freq {freq} refers to a frequency register, which is not supported')
+    return freq
+
+
+def _arb_phase(phase):
+    """A phase outside -360..+360 means no change, which A33ConfigureARB spells 360."""
+    return phase if -360 <= phase < 360 else 360
+
+
+# NAME -> function of the line's parameters after DeviceID, returning
+# (method name, keyword arguments)
+A33_OPCODES = {
+    'A33INI': lambda: ('A33Initialize', dict(reset=False)),
+    'A33WFM': lambda channel, func, ampl, offset, freq, phase=0, log_freq=0: (
+        'A33ConfigureWFM',
+        dict(channel=_ch(channel), waveform=func, amplitude=ampl, dc_offset=offset,
+             frequency_bw_bitrate=_freq(freq), phase=phase),
+    ),
+    'A33PUL': lambda channel, period, width, lead_edge=4e-9, trail_edge=4e-9: (
+        'A33ConfigurePulse',
+        dict(channel=_ch(channel), pulse_period=period, pulse_width=width,
+             leading_edge=lead_edge, trailing_edge=trail_edge),
+    ),
+    'A33ERARB': lambda channel: ('A33ClearArbitrary', dict(channel=_ch(channel))),
+    'A33ARBVOL': lambda channel, wfm_slot, wfm_file, wfm_len, wfm_source: (
+        'A33LoadArbitraryVolat',
+        dict(channel=_ch(channel), arb_number=wfm_slot, wfm_column_number=wfm_file,
+             wfm_length=wfm_len if wfm_len > 0 else None, wfm_source=wfm_source),
+    ),
+    'A33ARB': lambda channel, arb_number, ampl, offset, q_freq_sr_per, freq_sr_per, filt, phase, adv_mode: (
+        'A33ConfigureARB',
+        dict(channel=_ch(channel), arb_number=arb_number, amplitude=ampl, f_sr_p_key=q_freq_sr_per,
+             phase=_arb_phase(phase), filter_key=filt, dc_offset=offset, advance_mode=_on(adv_mode),
+             freq_sample_rate_period=freq_sr_per),
+    ),
+    'A33TRGCONF': lambda channel, source, slope, int_period, level, delay: (
+        'A33ConfigureTrigger',
+        dict(channel=_ch(channel), trigger_source=source, trigger_slope=slope, delay=delay,
+             int_period=int_period, trigger_level=level),
+    ),
+    'A33BURST': lambda channel, state, mode, count, int_period, phase, gate_polarity: (
+        'A33ConfigureBurst',
+        dict(channel=_ch(channel), burst_mode=_on(mode), burst_phase=phase, burst_count=count,
+             gate_polarity=_on(gate_polarity), internal_period=int_period, enable_burst=_on(state)),
+    ),
+    'A33OUT': lambda channel, state, impedance, polarity, mode: (
+        'A33OutputOnOff',
+        dict(channel=_ch(channel), enable_output=_on(state), output_mode=_on(mode),
+             polarity=_on(polarity), impedance=impedance),
+    ),
+    'A33PSYNC': lambda arb_q: ('A33ArbPhaseSync' if _on(arb_q) else 'A33PhaseSync', {}),
+    'A33TRG': lambda: ('A33Trg', {}),
+    'A33AM': lambda channel, on_off, source, modul_wfm, depth, modul_freq, carrier_supp: (
+        'A33ConfigureAM',
+        dict(channel=_ch(channel), am_source=source, modulation_waveform=modul_wfm,
+             modulation_frequency=modul_freq, enable_carrier_suppression=_on(carrier_supp),
+             enable_amplitude_modulation=_on(on_off), modulation_depth=depth),
+    ),
+    'A33FM': lambda channel, on_off, source, modul_wfm, dev_freq, modul_freq: (
+        'A33ConfigureFM',
+        dict(channel=_ch(channel), enable_frequency_modulation=_on(on_off), fm_source=source,
+             modulation_waveform=modul_wfm, modulation_deviation=dev_freq,
+             modulation_frequency=modul_freq),
+    ),
+    'A33SWEEP': lambda channel, state, start_freq, stop_freq, sweep_time, hold_time, ret_time, spacing: (
+        'A33ConfigureFSweep',
+        dict(channel=_ch(channel), enable_frequency_sweep=_on(state), sweep_spacing=spacing,
+             sweep_time=sweep_time, hold_time=hold_time, return_time=ret_time,
+             start_frequency=start_freq, stop_frequency=stop_freq),
+    ),
+}
+
+
+def _number(token):
+    value = float(token)
+    return int(value) if value.is_integer() else value
+
+
+def _resolve_device(device_id):
+    if device_id in device_ids:
+        return device_ids[device_id]
+    a33 = [name for name, dev in devices.items() if hasattr(dev, 'A33Trg')]
+    if len(a33) == 1:
+        return a33[0]
+    raise KeyError(f'No device registered for DeviceID {device_id} (set core.Program.device_ids)')
+
+
+class Step:
+    """One validated program line, ready to run."""
+
+    def __init__(self, line_no, command_n, name, instr, method_name, kwargs, call):
+        self.line_no = line_no
+        self.command_n = command_n
+        self.name = name
+        self.instr = instr
+        self.method_name = method_name
+        self.kwargs = kwargs
+        self.call = call
+
+    def __repr__(self):
+        return f'Step({self.line_no}: {self.name} -> {self.instr}.{self.method_name}({self.kwargs}))'
+
+
+class Program:
+    """
+    A parsed and validated program.
+
+    wfm_file is the waveform file (or NAME_nn file set) used by A33ARBVOL
+    lines with WFMSource 0 or 1, which the program lines don't name.
+    With skip_unknown=True, lines for other instruments are ignored instead
+    of being an error (e.g. when LabVIEW still runs those).
+    """
+
+    def __init__(self, text, wfm_file=None, skip_unknown=False):
+        self.digest = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+        self.steps = []
+        errors = []
+        for line_no, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                step = self._parse_line(line_no, line, wfm_file)
+            except Exception as e:
+                if skip_unknown and isinstance(e, UnknownCommand):
+                    continue
+                errors.append(f'line {line_no} ({line.strip()[:60]}): {_message(e)}')
+                continue
+            if step is not None:
+                self.steps.append(step)
+        if errors:
+            raise ValueError('Invalid program:\n' + '\n'.join(errors))
+        # Steps are bound to these device instances
+        self.devices = {step.instr: devices[step.instr] for step in self.steps}
+
+    def is_current(self):
+        """False once one of the program's devices has been re-registered."""
+        return all(devices.get(instr) is dev for instr, dev in self.devices.items())
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path) as f:
+            return cls(f.read(), **kwargs)
+
+    @staticmethod
+    def _parse_line(line_no, line, wfm_file):
+        fields = [f.strip() for f in line.split('\t')]
+        if len(fields) < 3:
+            raise ValueError('expected CommandN, code, NAME, params...')
+        command_n, _, name, *params = fields
+        if name in NO_OPS:
+            return None
+        if name not in A33_OPCODES:
+            raise UnknownCommand(f'unsupported command {name}')
+        if not params:
+            raise ValueError('missing DeviceID')
+        device_id, *params = [_number(p) for p in params]
+        instr = _resolve_device(device_id)
+
+        try:
+            method_name, kwargs = A33_OPCODES[name](*params)
+        except TypeError:
+            raise ValueError(f'wrong number of parameters ({len(params)} after DeviceID)') from None
+        if method_name == 'A33LoadArbitraryVolat' and kwargs['wfm_source'] != 2:
+            kwargs['wfm_file'] = wfm_file
+
+        try:
+            command = Dispatch.table[instr, method_name]
+        except KeyError:
+            raise KeyError(f'{instr} has no command {method_name}') from None
+        return Step(line_no, command_n, name, instr, method_name, kwargs, command.prepare(**kwargs))
+
+    def run(self, submit=None, stop_on_error=True):
+        """
+        Run the steps in order and return their replies.
+
+        Consecutive steps for one device run together inside its batch()
+        block (when it has one), so their writes are coalesced.
+        submit(instr, fn) runs fn for that device and returns its result
+        (the server passes the device's worker); by default steps run here.
+        """
+        results = []
+        for instr, group in itertools.groupby(self.steps, key=lambda step: step.instr):
+            group = list(group)
+            if submit is None:
+                replies, failed = _run_steps(instr, group, stop_on_error)
+            else:
+                replies, failed = submit(instr, lambda: _run_steps(instr, group, stop_on_error))
+            results += replies
+            if failed and stop_on_error:
+                break
+        return results
+
+
+def _message(e):
+    if isinstance(e, KeyError) and e.args:
+        return str(e.args[0])
+    return str(e)
+
+
+def _run_steps(instr, steps, stop_on_error):
+    replies = []
+    failed = False
+    coalesce = getattr(devices[instr], 'batch', None) if len(steps) > 1 else None
+    with (coalesce() if coalesce else nullcontext()):
+        for step in steps:
+            try:
+                result = step.call()
+            except Exception as e:
+                replies.append(f'ERROR line {step.line_no} ({step.name}): {e}')
+                failed = True
+                if stop_on_error:
+                    break
+            else:
+                replies.append('Operation complete' if result is None else str(result))
+    return replies, failed
@@ -1,12 +1,232 @@
 import zmq
+import zmq.asyncio
 import json
-from core import devices
+import time
+import asyncio
+import threading
+import itertools
+import traceback
+import numpy as np
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import os
+from core import devices, Jobs, Dispatch, Metrics, Tracing, Startup, long_running
+from core.Program import Program
+from core import Compiler
 
-def handle_tcp(message):
-    message_json = json.loads(message)
+REPLY_ADDR = "inproc://device-replies"
+
+# Sample types accepted in binary array frames (little-endian)
+ARRAY_DTYPES = {'int16': '<i2', 'float32': '<f4', 'float64': '<f8'}
+
+# One single-thread executor per device: commands to the same instrument run
+# strictly in order, commands to different instruments run in parallel.
+workers = {}    # { "AG33600A_Gen1": ThreadPoolExecutor(max_workers=1) }
+
+# Commands without an 'instr' key (server_commands) run here
+server_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='server')
+
+# Server commands run as jobs (run_program...), and those that wait for the
+# device workers, get their own threads, so they can't hold up job_status,
+# job_result and the other server commands
+job_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='job')
+
+_local = threading.local()
+_reply_sockets = []
+_reply_sockets_lock = threading.Lock()
+
+
+# ---------------------------------------------------------------------------
+# Server commands
+# ---------------------------------------------------------------------------
+
+def job_status(job_id):
+    """'pending', 'running', 'done' or 'failed'."""
+    return Jobs.status(job_id)
+
+
+def job_result(job_id, timeout=None):
+    """
+    Wait up to timeout seconds (forever if None) for a job and return its
+    reply. The job is forgotten once its result has been returned.
+
+    Without a timeout the servers answer once the job is done, without
+    keeping a thread waiting for it (see _waits_for_job).
+    """
+    future = Jobs.get(job_id)
+    try:
+        result_msg = future.result(timeout)
+    except FutureTimeoutError:
+        return f'ERROR job {job_id} is still {Jobs.status(job_id)}'
+    except Exception as e:
+        Jobs.forget(job_id)
+        return _error_reply(e, f'job {job_id}')
+    Jobs.forget(job_id)
+    return result_msg
+
+
+def batch(commands, stop_on_error=False):
+    """
+    Run a list of commands in order and return their replies as a JSON list.
+
+    Consecutive commands for the same instrument run together on that
+    instrument's worker inside its batch() (or using_write_buffer()) block, so
+    drivers that support it (Agilent33600A) coalesce their writes into one
+    SCPI message.
+    With stop_on_error the batch ends at the first failing command.
+    """
+    results = []
+    for instr, group in itertools.groupby(commands, key=lambda m: m.get('instr')):
+        group = list(group)
+        if instr in devices:
+            replies, failed = get_worker(instr).submit(_run_group, instr, group, stop_on_error).result()
+        else:
+            # Server commands (and unknown instruments, which just fail) run here
+            replies, failed = _run_group(instr, group, stop_on_error)
+        results += replies
+        if failed and stop_on_error:
+            break
+    return json.dumps(results)
+
+
+# Parsed programs, so rerunning an unchanged program file skips parsing and validation.
+# Least recently used first; every edit of a file adds a key, so the oldest are dropped.
+_programs = OrderedDict()  # { (path, mtime, wfm_file, skip_unknown): Program }
+_programs_lock = threading.Lock()
+MAX_PROGRAMS = 64
+
+
+@long_running
+def run_program(path=None, text=None, wfm_file=None, skip_unknown=False, stop_on_error=True):
+    """
+    Run a CommandSetC11v027 program (a file path or its text) server-side
+    and return the replies of its steps as a JSON list (see core.Program).
+    The whole program is validated before its first step runs.
+    """
+    if (path is None) == (text is None):
+        raise ValueError('run_program needs either path or text')
+    if path is not None:
+        key = (os.path.abspath(path), os.path.getmtime(path), wfm_file, skip_unknown)
+        with _programs_lock:
+            program = _programs.get(key)
+            if program is not None:
+                _programs.move_to_end(key)
+        if program is None or not program.is_current():
+            program = Program.load(path, wfm_file=wfm_file, skip_unknown=skip_unknown)
+            with _programs_lock:
+                _programs[key] = program
+                _programs.move_to_end(key)
+                if len(_programs) > MAX_PROGRAMS:
+                    _programs.popitem(last=False)
+    else:
+        program = Program(text, wfm_file=wfm_file, skip_unknown=skip_unknown)
+    submit = lambda instr, fn: get_worker(instr).submit(fn).result()
+    return json.dumps(program.run(submit, stop_on_error))
+
+
+def compile_program(path=None, text=None, commands=None, params=None, wfm_file=None, skip_unknown=False):
+    """
+    Compile a program (a CommandSetC11v027 file or text, or a list of JSON
+    commands) to the SCPI messages it sends, for fast replays with
+    run_compiled (see core.Compiler). params gives each parameter's default.
+    Returns JSON with the program ID, its step counts and its parameters.
+    """
+    if sum(source is not None for source in (path, text, commands)) != 1:
+        raise ValueError('compile_program needs one of path, text or commands')
+    if path is not None:
+        with open(path) as f:
+            text = f.read()
+    source = text if text is not None else commands
+    params = params or {}
+    program_id = Compiler.program_id(source, params, wfm_file, skip_unknown)
+    program = Compiler.compiled.get(program_id)
+    if program is None:
+        submit = lambda instr, fn: get_worker(instr).submit(fn).result()
+        program = Compiler.CompiledProgram(source, params, wfm_file, skip_unknown, submit)
+        Compiler.compiled[program_id] = program
+    return json.dumps(program.describe())
+
+
+def run_compiled(program_id, params=None, stop_on_error=True):
+    """Replay a compiled program with some parameters changed; replies as a JSON list."""
+    try:
+        program = Compiler.compiled[program_id]
+    except KeyError:
+        raise KeyError(f'Unknown compiled program {program_id}') from None
+    return json.dumps(program.run(params, stop_on_error))
+
+
+def stats(reset=False, prometheus_path=None):
+    """
+    Per-command phase timings and per-device I/O counters as JSON (see
+    core.Metrics). prometheus_path also writes them in Prometheus text format;
+    reset=True starts counting again afterwards.
+    """
+    snapshot = Metrics.snapshot()
+    if prometheus_path is not None:
+        Metrics.write_prometheus(prometheus_path)
+    if reset:
+        Metrics.reset()
+    return json.dumps(snapshot)
+
+
+def ping():
+    """Health check, answered by the server loop itself (see _answers_inline)."""
+    return 'pong'
+
+
+def device_status():
+    """Connection state of every configured device as JSON (see core.Startup)."""
+    return json.dumps(Startup.status())
+
+
+def list_commands(device):
+    """
+    The commands of a device and their signatures, as JSON. The device is
+    named by 'device': a request's 'instr' routes it to that device instead.
+    """
+    if device not in devices:
+        raise KeyError(f'Unknown instrument {device}')
+    return json.dumps(Dispatch.describe(device))
+
+
+server_commands = {
+    'ping': ping,
+    'job_status': job_status,
+    'job_result': job_result,
+    'batch': batch,
+    'list_commands': list_commands,
+    'stats': stats,
+    'device_status': device_status,
+    'run_program': run_program,
+    'compile_program': compile_program,
+    'run_compiled': run_compiled,
+}
+
+
+# ---------------------------------------------------------------------------
+# Dispatch
+# ---------------------------------------------------------------------------
+
+def dispatch(message_json):
     cmd = message_json.pop('cmd')
-    instr = message_json.pop('instr')
-    result_msg = devices[instr].commands[cmd](**message_json)
+    instr = message_json.pop('instr', None)
+    if instr is None:
+        call = server_commands[cmd]
+    else:
+        try:
+            call = Dispatch.calls[instr][cmd]
+        except KeyError:
+            call = _connecting_command(instr, cmd).call
+    Metrics.count('commands', instr=instr)
+    Metrics.set_device(instr)
+    if Metrics.enabled or Tracing.enabled:
+        # Profiling: the command's phases are timed (and traced)
+        with Metrics.command(instr, cmd, message_json.get('channel')):
+            result_msg = call(**message_json)
+    else:
+        result_msg = call(**message_json)
 
     if result_msg is None:
         return 'Operation complete'
@@ -14,3 +234,327 @@ def handle_tcp(message):
         return result_msg
 
 
+def _connecting_command(instr, cmd):
+    """
+    The command of a device that may still be connecting: wait for it (until
+    the startup deadline, see core.Startup) before giving up.
+    """
+    if instr not in devices and instr in Startup.status():
+        if not Startup.wait_ready(instr):
+            raise KeyError(f'Instrument {instr} is not connected yet ({Startup.status()[instr]})')
+        command = Dispatch.table.get((instr, cmd))
+        if command is not None:
+            return command
+    raise KeyError(f'Unknown command {cmd} for {instr}')
+
+
+def load_message(message, frames=()):
+    """
+    Parse a request and attach its binary frames (see attach_arrays); a
+    top-level JSON list is shorthand for a batch.
+    """
+    start = time.perf_counter()
+    message_json = json.loads(message)
+    if isinstance(message_json, list):
+        message_json = {'cmd': 'batch', 'commands': message_json}
+    if frames or 'arrays' in message_json:
+        attach_arrays(message_json, frames)
+    if Metrics.enabled or Tracing.enabled:
+        end = time.perf_counter()
+        instr, cmd = message_json.get('instr'), message_json.get('cmd')
+        if Metrics.enabled:
+            Metrics.observe(instr, cmd, 'decode', end - start)
+        if Tracing.enabled:
+            Tracing.span(f'recv {cmd}', start, end, 'decode', instr, message_json.get('channel'))
+    return message_json
+
+
+def attach_arrays(message_json, frames):
+    """
+    Pass the binary frames that follow a JSON header as NumPy arguments.
+
+    The header lists them in frame order with their sample type:
+        {"instr": ..., "cmd": "A33LoadArbitraryVolat", ...,
+         "arrays": {"array_wfm": "int16"}}
+    Each array is a read-only view on its ZMQ frame, so nothing is parsed or
+    copied on the way in.
+    """
+    spec = message_json.pop('arrays', None) or {}
+    if len(spec) != len(frames):
+        raise ValueError(f'{len(frames)} binary frames for {len(spec)} arrays')
+    for (name, dtype), frame in zip(spec.items(), frames):
+        if dtype not in ARRAY_DTYPES:
+            raise ValueError(f'Unsupported array type {dtype}, expected one of {list(ARRAY_DTYPES)}')
+        buffer = frame.buffer if isinstance(frame, zmq.Frame) else frame
+        message_json[name] = np.frombuffer(buffer, dtype=ARRAY_DTYPES[dtype])
+
+
+def handle_tcp(message):
+    return dispatch(load_message(message))
+
+
+def _run_group(instr, group, stop_on_error):
+    """Run consecutive batch commands for one instrument (in its worker)."""
+    replies = []
+    failed = False
+    device = devices.get(instr)
+    coalesce = None
+    if len(group) > 1:
+        coalesce = getattr(device, 'batch', None) or getattr(device, 'using_write_buffer', None)
+    with (coalesce() if coalesce else nullcontext()):
+        for message_json in group:
+            request = dict(message_json)
+            try:
+                replies.append(str(dispatch(message_json)))
+            except Exception as e:
+                # repr() for what JSON can't show (arrays...)
+                replies.append(_error_reply(e, json.dumps(request, default=repr)))
+                failed = True
+                if stop_on_error:
+                    break
+    return replies, failed
+
+
+def get_worker(instr):
+    if instr not in workers:
+        # Counters of steps submitted directly (programs, batches) go to instr too
+        workers[instr] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=instr,
+                                            initializer=Metrics.set_device, initargs=(instr,))
+    return workers[instr]
+
+
+def _executor(message_json, job=False):
+    instr = message_json.get('instr')
+    if instr is None:
+        if job or message_json.get('cmd') in _waiting_commands:
+            return job_pool
+        return server_pool
+    if instr not in devices and instr not in Startup.status():
+        raise KeyError(f'Unknown instrument {instr}')
+    # A device still connecting gets its requests queued on its worker,
+    # where dispatch waits for it
+    return get_worker(instr)
+
+
+# Server commands that block on the device workers
+_waiting_commands = {'batch', 'run_program', 'compile_program', 'run_compiled'}
+
+
+# Server commands answered by the server loop itself, without going through
+# a worker, so they reply even while every worker is busy
+_inline_commands = {'ping', 'device_status'}
+
+
+def _answers_inline(message_json):
+    return message_json.get('instr') is None and message_json.get('cmd') in _inline_commands
+
+
+def _waits_for_job(message_json):
+    """
+    The future of the job a job_result request waits for without a timeout
+    (None for any other request): the reply is sent when it is done.
+    """
+    if message_json.get('instr') is not None or message_json.get('cmd') != 'job_result':
+        return None
+    if message_json.get('timeout') is not None:
+        return None
+    return Jobs.get(message_json.get('job_id'))
+
+
+def _wants_job(message_json):
+    """
+    A request runs as a background job if it says so ("job": true) or if the
+    command is marked @long_running and the request doesn't opt out.
+    """
+    job = message_json.pop('job', None)
+    if job is not None:
+        return bool(job)
+    instr = message_json.get('instr')
+    if instr is None:
+        return getattr(server_commands.get(message_json.get('cmd')), '_long_running', False)
+    command = Dispatch.table.get((instr, message_json.get('cmd')))
+    return getattr(command, 'long_running', False)
+
+
+def _error_reply(e, message):
+    print(f'Error: {e}')
+    print('Json message:')
+    print(message)
+    print('lead to an error')
+    traceback.print_exc()
+    return f'ERROR {e}'
+
+
+def _execute(message, message_json):
+    """dispatch() with any exception turned into an 'ERROR ...' reply."""
+    try:
+        return str(dispatch(message_json))
+    except Exception as e:
+        return _error_reply(e, message)
+
+
+def _split_envelope(frames):
+    """Split ROUTER frames into (routing envelope, body frames)."""
+    for i, frame in enumerate(frames):
+        if not frame:
+            return frames[:i + 1], frames[i + 1:]
+    return frames[:1], frames[1:]
+
+
+def _shutdown_workers():
+    for worker in workers.values():
+        worker.shutdown(wait=True)
+    workers.clear()
+
+
+# ---------------------------------------------------------------------------
+# Threaded ROUTER server
+# ---------------------------------------------------------------------------
+
+def _reply_socket(context):
+    # zmq sockets must not be shared between threads, so every worker thread
+    # gets its own PUSH socket towards the server loop
+    sock = getattr(_local, 'reply_socket', None)
+    if sock is None:
+        sock = context.socket(zmq.PUSH)
+        sock.connect(REPLY_ADDR)
+        _local.reply_socket = sock
+        with _reply_sockets_lock:
+            _reply_sockets.append(sock)
+    return sock
+
+
+def _run_and_reply(context, envelope, message, message_json):
+    """Runs in a worker thread."""
+    reply = _execute(message, message_json)
+    _reply_socket(context).send_multipart(envelope + [reply.encode()])
+
+
+def _reply_when_done(context, future, envelope, message, message_json):
+    """Answer a job_result request from the thread that finishes the job."""
+    future.add_done_callback(lambda _: _run_and_reply(context, envelope, message, message_json))
+
+
+def serve(context, address="tcp://*:5555", poll_timeout=1000):
+    """
+    Serve commands on a ROUTER socket until interrupted.
+
+    Each request is queued on the worker of its target device and the reply
+    is routed back to the client identity that sent it, so a long operation
+    on one instrument never blocks clients of another one.
+    Long-running commands reply 'JOB <id>' immediately (see job_status and
+    job_result). REQ, DEALER and ROUTER-aware clients are all supported.
+    A request may carry waveform arrays as extra binary frames after its
+    JSON frame (see attach_arrays).
+    """
+    router = context.socket(zmq.ROUTER)
+    replies = context.socket(zmq.PULL)
+    router.bind(address)
+    replies.bind(REPLY_ADDR)
+
+    poller = zmq.Poller()
+    poller.register(router, zmq.POLLIN)
+    poller.register(replies, zmq.POLLIN)
+
+    try:
+        while True:
+            events = dict(poller.poll(poll_timeout))
+
+            if replies in events:
+                while True:
+                    try:
+                        router.send_multipart(replies.recv_multipart(zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+
+            if router in events:
+                while True:
+                    try:
+                        # Frames are not copied out of zmq: array arguments are views on them
+                        frames = router.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    envelope, body = _split_envelope(frames)
+                    message = body[0].bytes.decode() if body else ''
+                    try:
+                        message_json = load_message(message, body[1:])
+                        if _answers_inline(message_json):
+                            router.send_multipart(envelope + [_execute(message, message_json).encode()])
+                            continue
+                        future = _waits_for_job(message_json)
+                        if future is not None:
+                            _reply_when_done(context, future, envelope, message, message_json)
+                            continue
+                        as_job = _wants_job(message_json)
+                        executor = _executor(message_json, as_job)
+                        if as_job:
+                            job_id = Jobs.submit(executor, dispatch, message_json)
+                            router.send_multipart(envelope + [f'JOB {job_id}'.encode()])
+                            continue
+                    except Exception as e:
+                        router.send_multipart(envelope + [_error_reply(e, message).encode()])
+                        continue
+                    executor.submit(_run_and_reply, context, envelope, message, message_json)
+    finally:
+        _shutdown_workers()
+        with _reply_sockets_lock:
+            for sock in _reply_sockets:
+                sock.close(linger=0)
+            _reply_sockets.clear()
+        router.close(linger=0)
+        replies.close(linger=0)
+
+
+# ---------------------------------------------------------------------------
+# Asyncio server
+# ---------------------------------------------------------------------------
+
+async def _handle_async(router, envelope, message, arrays):
+    loop = asyncio.get_running_loop()
+    try:
+        message_json = load_message(message, arrays)
+        inline = _answers_inline(message_json)
+        future = None if inline else _waits_for_job(message_json)
+        as_job = not inline and future is None and _wants_job(message_json)
+        executor = None if inline or future is not None else _executor(message_json, as_job)
+    except Exception as e:
+        reply = _error_reply(e, message)
+    else:
+        if inline:
+            reply = _execute(message, message_json)
+        elif future is not None:
+            # Awaited on the loop, so no thread waits for the job
+            await asyncio.wait([asyncio.wrap_future(future)])
+            reply = _execute(message, message_json)
+        elif as_job:
+            reply = f'JOB {Jobs.submit(executor, dispatch, message_json)}'
+        else:
+            # Submitted before the first await, so per-device order is kept
+            reply = await loop.run_in_executor(executor, _execute, message, message_json)
+    await router.send_multipart(envelope + [reply.encode()])
+
+
+async def serve_async(address="tcp://*:5555"):
+    """
+    Asyncio version of serve(): the event loop only receives and routes
+    messages, device commands run on the per-device workers, and
+    long-running commands become jobs that clients poll with job_status or
+    wait for with job_result.
+    """
+    context = zmq.asyncio.Context.instance()
+    router = context.socket(zmq.ROUTER)
+    router.bind(address)
+    pending = set()
+    try:
+        while True:
+            frames = await router.recv_multipart(copy=False)
+            envelope, body = _split_envelope(frames)
+            message = body[0].bytes.decode() if body else ''
+            task = asyncio.create_task(_handle_async(router, envelope, message, body[1:]))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    finally:
+        for task in pending:
+            task.cancel()
+        _shutdown_workers()
+        router.close(linger=0)
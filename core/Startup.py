@@ -0,0 +1,134 @@
+"""
+Connecting the configured devices in parallel at server startup.
+
+Every device is opened and registered in its own thread, so startup takes
+as long as the slowest device instead of the sum of them, and an
+unreachable instrument only delays itself. connect_devices() waits up to a
+deadline and returns; devices that aren't up by then keep connecting in the
+background (retrying after failures) and are registered, and served, as
+soon as they answer. Requests for a device that is still connecting wait
+for it until the deadline, then get an error saying so (see status()).
+
+With wait=False the server can start serving straight away; a driver class
+given by name is only imported (with pylablib behind it) in its device's
+connection thread.
+"""
+import importlib
+import threading
+import time
+
+from core import register_device, Metrics
+
+# { name: 'connecting' | 'ready' | 'retrying after <error>' }
+_status = {}
+_ready = {}         # { name: threading.Event set once registered }
+_opened = []        # devices to close on shutdown
+_lock = threading.Lock()
+_stop = threading.Event()
+_deadline = 0.0     # time.monotonic() until which requests wait for connecting devices
+
+
+def connect_devices(configs, deadline=10.0, retry_interval=30.0, fast=False, wait=True, **kwargs):
+    """
+    Open and register the devices of configs ({name: (class, addr)}; the
+    class may be given by its name in Equipment), each one in its own
+    thread, with kwargs passed to every constructor.
+
+    Waits at most deadline seconds (not at all if wait=False) and returns
+    the names registered by then; the others go on in the background,
+    retrying every retry_interval seconds after a failure. close_devices()
+    stops them and closes every opened device.
+    """
+    global _deadline
+    _stop.clear()
+    _deadline = time.monotonic() + deadline
+    threads = []
+    for name, (instrument_class, addr) in configs.items():
+        _status[name] = 'connecting'
+        _ready[name] = threading.Event()
+        thread = threading.Thread(
+            target=_connect, args=(name, instrument_class, addr, kwargs, fast, retry_interval),
+            name=f'connect-{name}', daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+
+    if not wait:
+        timer = threading.Timer(deadline, _report_late, args=(list(configs), deadline))
+        timer.daemon = True
+        timer.start()
+        return [name for name in configs if _status.get(name) == 'ready']
+    for thread in threads:
+        thread.join(max(0.0, _deadline - time.monotonic()))
+    return _report_late(list(configs), deadline)
+
+
+def _report_late(names, deadline):
+    ready = [name for name in names if _status.get(name) == 'ready']
+    late = [name for name in names if name not in ready]
+    if late and not _stop.is_set():
+        print(f'Still connecting after {deadline:g} s: {", ".join(late)} (serving the others)')
+    return ready
+
+
+def _connect(name, instrument_class, addr, kwargs, fast, retry_interval):
+    # The connection's I/O (*IDN?, setup writes) counts for the device
+    Metrics.set_device(name)
+    while not _stop.is_set():
+        _status[name] = 'connecting'
+        try:
+            if isinstance(instrument_class, str):
+                instrument_class = getattr(importlib.import_module('Equipment'), instrument_class)
+            device = instrument_class(addr, **kwargs)
+        except Exception as e:
+            _retry_later(name, e, retry_interval)
+            continue
+        try:
+            register_device(name, device, fast=fast)
+        except Exception as e:
+            device.close()
+            _retry_later(name, e, retry_interval)
+            continue
+        with _lock:
+            if _stop.is_set():
+                # Shut down while this one was connecting
+                device.close()
+                return
+            _opened.append(device)
+        _status[name] = 'ready'
+        _ready[name].set()
+        return
+
+
+def _retry_later(name, error, retry_interval):
+    _status[name] = f'retrying after {type(error).__name__}: {error}'
+    print(f'Could not connect {name}: {error} (retrying in {retry_interval:g} s)')
+    _stop.wait(retry_interval)
+
+
+def status():
+    """{name: 'connecting', 'ready' or 'retrying after <error>'} for every configured device."""
+    return dict(_status)
+
+
+def wait_ready(name):
+    """
+    Wait for a configured device that is still connecting, until the startup
+    deadline at most; True once it is registered.
+    """
+    event = _ready.get(name)
+    if event is None:
+        return False
+    return event.wait(max(0.0, _deadline - time.monotonic()))
+
+
+def close_devices():
+    """Stop the background connections and close every opened device."""
+    _stop.set()
+    with _lock:
+        opened, _opened[:] = list(_opened), []
+    for device in opened:
+        try:
+            device.close()
+        except Exception as e:
+            print(f'Error while closing {device.__class__.__name__}: {e}')
@@ -0,0 +1,131 @@
+"""
+Timeline of server activity in Chrome trace format (chrome://tracing,
+https://ui.perfetto.dev).
+
+While tracing is on, every received message, dispatched command and
+core.Metrics phase (VISA writes/reads, completion waits) is recorded as a
+span on the thread that ran it, tagged with its device and channel. Each
+start() writes a new trace file (trace_<date>_<time>.json) in the trace
+directory and only the last `keep` runs are kept; long runs continue in
+_partN files every max_events events.
+
+Events are written by a background thread, the instrumented code only
+appends to a queue.
+"""
+import os
+import json
+import time
+import glob
+import threading
+from collections import deque
+from datetime import datetime
+
+enabled = False
+
+_events = deque()
+_thread_names = {}  # { thread ident: name } already written
+_state = {}         # run, part, path, file, written, max_events, origin, writer, stop
+_lock = threading.Lock()
+
+
+def span(name, start, end, cat, instr=None, channel=None, detail=None):
+    """A complete event from perf_counter() start to end."""
+    thread = threading.current_thread()
+    args = {}
+    if instr is not None:
+        args['instr'] = instr
+    if channel is not None:
+        args['channel'] = channel
+    if detail is not None:
+        args['detail'] = detail if len(detail) <= 200 else detail[:200] + '...'
+    _events.append((name, cat, start, end - start, thread.ident, thread.name, args))
+
+
+def start(directory='traces', keep=10, max_events=1_000_000, flush_interval=0.5):
+    """Start tracing into a new file in directory; returns its path."""
+    stop()
+    os.makedirs(directory, exist_ok=True)
+    old = sorted(glob.glob(os.path.join(directory, 'trace_*.json')))
+    runs = sorted({os.path.basename(p).split('_part')[0].removesuffix('.json') for p in old})
+    for run in runs[:max(0, len(runs) - keep + 1)]:
+        for path in glob.glob(os.path.join(directory, run + '*.json')):
+            os.remove(path)
+
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    _state.update(
+        run=os.path.join(directory, f'trace_{stamp}'),
+        part=1,
+        max_events=max_events,
+        origin=time.perf_counter(),
+        stop=threading.Event(),
+    )
+    _open_part()
+    writer = threading.Thread(target=_write_loop, args=(flush_interval,), name='trace-writer', daemon=True)
+    _state['writer'] = writer
+    writer.start()
+    global enabled
+    enabled = True
+    return _state['path']
+
+
+def stop():
+    """Stop tracing and close the trace file."""
+    global enabled
+    enabled = False
+    writer = _state.pop('writer', None)
+    if writer is None:
+        return
+    _state['stop'].set()
+    writer.join()
+    _flush()
+    _close_part()
+
+
+def _open_part():
+    part = _state['part']
+    path = _state['run'] + ('.json' if part == 1 else f'_part{part}.json')
+    _state.update(path=path, file=open(path, 'w'), written=0)
+    _state['file'].write('[')
+    _thread_names.clear()
+    _write({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0, 'args': {'name': 'QD server'}})
+
+
+def _close_part():
+    f = _state.pop('file')
+    f.write('\n]\n')
+    f.close()
+
+
+def _write(event):
+    # Until it is closed the file is an unterminated JSON array, which the
+    # trace viewers also accept (e.g. after a crash)
+    _state['file'].write((',\n' if _state['written'] else '\n') + json.dumps(event))
+    _state['written'] += 1
+
+
+def _flush():
+    pid = os.getpid()
+    origin = _state['origin']
+    with _lock:
+        while _events:
+            name, cat, start, duration, tid, thread_name, args = _events.popleft()
+            if _thread_names.get(tid) != thread_name:
+                _thread_names[tid] = thread_name
+                _write({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+            _write({
+                'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': (start - origin) * 1e6, 'dur': duration * 1e6, 'args': args,
+            })
+            if _state['written'] >= _state['max_events']:
+                _close_part()
+                _state['part'] += 1
+                _open_part()
+        _state['file'].flush()
+
+
+def _write_loop(interval):
+    while not _state['stop'].wait(interval):
+        try:
+            _flush()
+        except OSError as e:
+            print(f'Could not write trace: {e}')
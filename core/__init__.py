@@ -1,4 +1,5 @@
 import inspect 
+from core import Dispatch
 
 devices = {}    # { "SDG1": <instance>, "Scope1": <instance> }
 
@@ -16,8 +17,32 @@ def get_public_commands(instance):
             commands[name] = method
     return commands
 
-def register_device(name, instance):
+def long_running(method):
+    """
+    Mark a device command as long-running: servers run it as a background
+    job and reply with a job ID straight away (see core.Jobs).
+    """
+    method._long_running = True
+    return method
+
+def runs_live(method):
+    """
+    Mark a device command that must really run when a compiled program is
+    replayed (see core.Compiler), because it does more than write SCPI
+    settings (resets, cache invalidation, raw transfers...).
+    """
+    method._runs_live = True
+    return method
+
+def register_device(name, instance, fast=False):
+    """
+    Register a connected device and build its dispatch table entries.
+    fast=True trusts the clients: identical arguments are only validated once
+    (see core.Dispatch.Command).
+    """
     idn = instance.ask('*IDN?')
     print(f'Succesfully connected to {idn} \nRegistered {name} as an instance of {instance.__class__.__name__}\n')
+    commands = getattr(instance, 'commands', None) or get_public_commands(instance)
+    Dispatch.compile_device(name, commands, fast)
     devices[name] = instance
     
\ No newline at end of file
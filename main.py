@@ -1,55 +1,84 @@
 import zmq
+import asyncio
 from contextlib import ExitStack
-import traceback
 
-from core.Server import handle_tcp
+from core.Server import serve, serve_async
 # from core.Registry import register_device, commands, devices
 
-from Equipment import Agilent33600A
-from core import register_device, devices
+from core import Program, Metrics, Tracing, Startup
 
+# Driver classes are given by name: each one is imported (with pylablib
+# behind it) by its device's connection thread, after the server is up
 device_configs = {
-    'AG33600A_Gen1' : (Agilent33600A, 'TCPIP::169.254.11.23::INSTR'),
-    # 'AG33600A_Gen1' : (Agilent33600A, 'TCPIP::169.254.49.101::5025::SOCKET'),
-    # 'SDG6022X_Gen1' : SDG6022X('TCPIP::169.254.11.24::INSTR'),
+    'AG33600A_Gen1' : ('Agilent33600A', 'TCPIP::169.254.11.23::INSTR'),
+    # 'AG33600A_Gen1' : ('Agilent33600A', 'TCPIP::169.254.49.101::5025::SOCKET'),
+    # 'SDG6022X_Gen1' : ('SDG6022X', 'TCPIP::169.254.11.24::INSTR'),
 }
 
+# VISA transport of the generators: None to use the addresses as they are,
+# 'inst' (VXI-11), 'hislip' or 'socket' (port 5025) on the same host, or
+# 'auto' to time each of them at connect time and keep the fastest
+transport = None
 
-with ExitStack() as stack:
-    for instrument_name, (instrument_class, addr) in device_configs.items():
-        dev = stack.enter_context(instrument_class(addr))
-        register_device(instrument_name, dev)
+# The server answers straight away; requests for a device still connecting
+# wait for it up to startup_deadline seconds. Devices not up by then (or
+# unreachable) keep connecting in the background, retrying every
+# retry_interval seconds, and are served as soon as they answer
+startup_deadline = 10.0
+retry_interval = 30.0
 
-    context = stack.enter_context(zmq.Context())
-    socket = stack.enter_context(context.socket(zmq.REP))
-    socket.bind("tcp://*:5555")
-    socket.RCVTIMEO = 1000
+# DeviceID used in CommandSetC11v027 programs -> device name (see run_program)
+Program.device_ids.update({33600: 'AG33600A_Gen1'})
 
+# 'threaded': ROUTER loop + per-device worker threads
+# 'async':    asyncio front end, same workers
+server_mode = 'threaded'
 
-    run = True
-    while run:
+# Trusted clients: validate each distinct set of command arguments only once
+fast_dispatch = False
+
+# Time every command and its phases (decode, validate, io, wait) for the
+# 'stats' command; off, only commands and I/O bytes are counted, which
+# keeps the dispatch path at full speed
+profile = False
+
+# Prometheus text file with the command timings and I/O counters (see the
+# 'stats' command), rewritten every 10 s; None to only serve them over ZMQ
+metrics_file = None     # e.g. 'qd_server.prom'
+
+# Directory for a Chrome/Perfetto timeline of each run (messages, commands,
+# VISA I/O, *OPC? and completion waits), see core.Tracing; None to not trace
+trace_dir = None        # e.g. 'traces'
+
+
+# Guarded: the waveform synthesis processes (Equipment.waveform_synth) are
+# spawned, and import this module again
+if __name__ == '__main__':
+    # Before the devices register: their commands are built for it
+    Metrics.enabled = profile
+    if metrics_file is not None:
+        Metrics.start_prometheus_dump(metrics_file)
+    if trace_dir is not None:
+        print(f'Tracing to {Tracing.start(trace_dir)}')
+
+    with ExitStack() as stack:
+        # All devices connect in parallel, in the background (see core.Startup)
+        stack.callback(Startup.close_devices)
+        Startup.connect_devices(
+            device_configs, deadline=startup_deadline, retry_interval=retry_interval,
+            fast=fast_dispatch, wait=False, transport=transport,
+        )
+
+        # Commands for different instruments run in parallel, commands for the
+        # same instrument run in the order they were received
         try:
-            message = socket.recv_string()
-            return_msg = handle_tcp(message)
-            socket.send_string(return_msg)
-            
-        except zmq.Again:
-            # print('Waiting for command')
-            continue
-        
+            if server_mode == 'async':
+                asyncio.run(serve_async("tcp://*:5555"))
+            else:
+                context = stack.enter_context(zmq.Context())
+                serve(context, "tcp://*:5555")
         except KeyboardInterrupt:
             print('Closing connections')
-            run = False
-            
-        except Exception as e:
-            print(f'Error: {e}')
-            print('Json message:')
-            print(message)
-            print('lead to an error')
-
-            traceback.print_exc()
-            socket.send_string(f'ERROR {e}')
-
-            # run=False
 
-print('Connections closed.')
\ No newline at end of file
+    Tracing.stop()
+    print('Connections closed.')
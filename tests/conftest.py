@@ -0,0 +1,41 @@
+"""
+Tests against the simulated instruments of Test files/Instrument_simulator.py,
+so no hardware is needed:
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'Test files')]
+
+import Instrument_simulator  # noqa: E402
+
+
+@pytest.fixture
+def simulator():
+    """A simulated 33600A on a free local port."""
+    server = Instrument_simulator.start(model='33600a', port=0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def awg(simulator):
+    from Equipment import Agilent33600A
+    device = Agilent33600A(simulator.address)
+    yield device
+    device.close()
+
+
+@pytest.fixture
+def registered(awg):
+    """awg registered with the server core as 'AG'."""
+    import core
+    core.register_device('AG', awg)
+    yield 'AG'
+    core.devices.pop('AG', None)
@@ -0,0 +1,62 @@
+import pytest
+
+from core import Compiler
+
+ARB = dict(channel=1, arb_number=1, amplitude=1.0, f_sr_p_key=0, filter_key=0, dc_offset=0.0,
+           advance_mode=False, freq_sample_rate_period=1000.0)
+WFM = dict(channel=2, amplitude=1.0, dc_offset=0.0, frequency_bw_bitrate=1e3, phase=0.0)
+
+
+def _settings_after(awg, simulator, run):
+    """The instrument settings run() leaves, starting from a reset instrument."""
+    simulator.instrument.reset()
+    awg._shadow.invalidate()
+    run()
+    # Writes don't wait for the simulator: *OPC? is answered once they are done
+    awg.ask('*OPC?')
+    return dict(simulator.instrument.settings)
+
+
+@pytest.fixture
+def program(registered):
+    commands = [
+        dict(ARB, instr=registered, cmd='A33ConfigureARB', phase={'$param': 'phase'}),
+        dict(WFM, instr=registered, cmd='A33ConfigureWFM', waveform={'$param': 'waveform'}),
+    ]
+    return Compiler.CompiledProgram(commands, dict(phase=10.0, waveform=0))
+
+
+def test_parameters_are_not_structural(program):
+    assert program.describe()['slots'] == ['phase', 'waveform']
+    assert program.describe()['structural'] == []
+
+
+# 360 skips the ARB phase, noise and DC leave out the frequency and phase
+@pytest.mark.parametrize('phase', [10.0, -90.5, 360.0])
+@pytest.mark.parametrize('waveform', [0, 4, 5])
+def test_compiled_run_matches_direct_calls(awg, simulator, program, phase, waveform):
+    compiled = _settings_after(awg, simulator, lambda: program.run(dict(phase=phase, waveform=waveform)))
+    direct = _settings_after(awg, simulator, lambda: (
+        awg.A33ConfigureARB(phase=phase, **ARB),
+        awg.A33ConfigureWFM(waveform=waveform, **WFM),
+    ))
+    assert compiled == direct
+
+
+def test_device_is_not_patched_while_recording(awg, program):
+    assert 'write' not in vars(awg)
+
+
+def test_structural_parameter_compiles_a_variant(awg, simulator, registered):
+    program = Compiler.CompiledProgram('1\t0\tA33PSYNC\t33600\t$arb\n', dict(arb=0))
+    assert program.describe()['structural'] == ['arb']
+    assert program.run(dict(arb=1)) == ['Operation complete']
+    assert [step.cmd for step in program.variants[(('arb', 1),)]] == ['A33ArbPhaseSync']
+
+
+def test_program_line_values_are_translated(awg, simulator, registered):
+    program = Compiler.CompiledProgram('1\t0\tA33BURST\t33600\t$ch\t1\t0\t$count\t1.\t0.\t0\n',
+                                       dict(ch=0, count=5))
+    program.run(dict(ch=1, count=0))
+    awg.ask('*OPC?')
+    assert simulator.instrument.settings['SOUR2:BURS:NCYC'] == 'INF'
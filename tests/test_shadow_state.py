@@ -0,0 +1,57 @@
+import pytest
+from pylablib.devices.AWG.generic import GenericAWG
+
+from Equipment.shadow_state import ShadowState
+
+
+def _fail_next_write(monkeypatch):
+    """Make the next VISA write of the driver fail, as on a dropped link."""
+    write = GenericAWG._instr_write
+
+    def flaky(self, msg):
+        monkeypatch.setattr(GenericAWG, '_instr_write', write)
+        raise OSError('link down')
+
+    monkeypatch.setattr(GenericAWG, '_instr_write', flaky)
+
+
+def test_unchanged_settings_are_dropped():
+    shadow = ShadowState()
+    assert shadow.filter(':SOUR1:VOLT 1;:SOUR1:FREQ 10') == ':SOUR1:VOLT 1;:SOUR1:FREQ 10'
+    assert shadow.filter(':SOUR1:VOLT 1;:SOUR1:FREQ 20') == ':SOUR1:FREQ 20'
+    assert shadow.filter('*TRG') == '*TRG'
+
+
+def test_repeated_write_is_suppressed(awg, simulator):
+    awg.A33OutputOnOff(1, True, False, False, 50)
+    # Writes don't wait for the simulator: *OPC? is answered once they are done
+    awg.ask('*OPC?')
+    messages = simulator.instrument.messages
+    awg.A33OutputOnOff(1, True, False, False, 50)
+    awg.ask('*OPC?')
+    assert simulator.instrument.messages == messages + 1
+
+
+def test_failed_write_invalidates_shadow(awg, simulator, monkeypatch):
+    _fail_next_write(monkeypatch)
+    with pytest.raises(OSError):
+        awg.A33OutputOnOff(1, True, False, False, 50)
+    assert 'OUTP1' not in simulator.instrument.settings
+
+    # The settings never arrived, so the same call must send them
+    awg.A33OutputOnOff(1, True, False, False, 50)
+    awg.ask('*OPC?')
+    assert simulator.instrument.settings['OUTP1'] == 'ON'
+
+
+def test_failed_batch_sends_nothing(awg, simulator):
+    messages = simulator.instrument.messages
+    with pytest.raises(RuntimeError):
+        with awg.batch():
+            awg.A33OutputOnOff(1, True, False, False, 50)
+            raise RuntimeError('stop')
+    assert simulator.instrument.messages == messages
+
+    awg.A33OutputOnOff(1, True, False, False, 50)
+    awg.ask('*OPC?')
+    assert simulator.instrument.settings['OUTP1'] == 'ON'
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+
+def _upload(awg, waveform, arb_number=1, channel=1):
+    awg.A33LoadArbitraryVolat(channel, arb_number, wfm_source=2, array_wfm=waveform)
+
+
+def test_identical_upload_is_skipped(awg, simulator):
+    waveform = np.arange(-500, 500, dtype='<i2')
+    _upload(awg, waveform)
+    sent = simulator.instrument.block_bytes
+    assert sent == waveform.nbytes
+
+    _upload(awg, waveform.copy())
+    assert simulator.instrument.block_bytes == sent
+    assert awg._wfm_cache.hits == 1
+
+
+def test_changed_waveform_is_uploaded(awg, simulator):
+    waveform = np.arange(-500, 500, dtype='<i2')
+    _upload(awg, waveform)
+    _upload(awg, waveform[::-1].copy())
+    assert simulator.instrument.block_bytes == 2 * waveform.nbytes
+    assert awg._wfm_cache.misses == 2
+    assert simulator.instrument.arbs[1]['ARB1'][0] == len(waveform)
+
+
+def test_other_slot_is_uploaded(awg, simulator):
+    waveform = np.zeros(100, dtype='<i2')
+    _upload(awg, waveform, arb_number=1)
+    _upload(awg, waveform, arb_number=2)
+    assert simulator.instrument.block_bytes == 2 * waveform.nbytes
+
+
+def test_clear_forgets_resident_waveforms(awg, simulator):
+    waveform = np.zeros(100, dtype='<i2')
+    _upload(awg, waveform)
+    awg.A33ClearArbitrary(1)
+    _upload(awg, waveform)
+    assert simulator.instrument.block_bytes == 2 * waveform.nbytes
+
+
+@pytest.mark.parametrize('points', [4, 4_000_001])
+def test_length_is_checked_before_upload(awg, simulator, points):
+    messages = simulator.instrument.messages
+    with pytest.raises(ValueError):
+        _upload(awg, np.zeros(points, dtype='<i2'))
+    assert simulator.instrument.messages == messages
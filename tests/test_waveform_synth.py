@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from Equipment import waveform_synth
+from Equipment.waveform_io import iter_dac_chunks, prefetch, read_waveform
+
+SPEC = {
+    "points": 10_000,
+    "components": [
+        {"type": "tone", "amplitude": 1, "frequency": 17},
+        {"type": "pulses", "amplitude": 0.5, "period": 0.1, "width": 0.02},
+    ],
+}
+
+
+def test_render_is_full_scale():
+    samples = waveform_synth.render(SPEC)
+    assert samples.dtype == np.dtype('<i2')
+    assert len(samples) == SPEC['points']
+    assert np.abs(samples).max() == 32767
+
+
+def test_ranges_match_the_whole_waveform():
+    whole = waveform_synth.render(SPEC)
+    prepared = waveform_synth.prepare(SPEC)
+    assert np.array_equal(waveform_synth.render(prepared, 1234, 5678), whole[1234:5678])
+    assert np.array_equal(np.concatenate(list(waveform_synth.iter_chunks(SPEC, 3000))), whole)
+
+
+@pytest.mark.parametrize('points', [0, 16 * 4_000_000 + 1])
+def test_points_are_bounded(points):
+    with pytest.raises(ValueError):
+        waveform_synth.prepare(dict(SPEC, points=points))
+
+
+def test_array_chunks_are_views():
+    waveform = np.arange(10_000, dtype='<i2')
+    chunks = list(iter_dac_chunks(waveform, 3000))
+    assert [len(c) for c in chunks] == [3000, 3000, 3000, 1000]
+    assert all(np.shares_memory(c, waveform) for c in chunks)
+
+
+def test_text_file_chunks(tmp_path):
+    path = tmp_path / 'wfm.txt'
+    path.write_text('\n'.join(map(str, range(-50, 50))) + '\n')
+    assert np.array_equal(np.concatenate(list(iter_dac_chunks(str(path), 30))), np.arange(-50, 50))
+    with pytest.raises(ValueError):
+        read_waveform(str(path), 99)
+
+
+def test_prefetch_keeps_order_and_reraises():
+    def produce():
+        yield from range(5)
+        raise KeyError('producer')
+
+    items = prefetch(produce(), depth=2)
+    assert [next(items) for _ in range(5)] == list(range(5))
+    with pytest.raises(KeyError):
+        next(items)